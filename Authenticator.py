@@ -1,9 +1,13 @@
 import base64
 import json
-import requests
 import logging
+import time
 from enum import Enum
 
+from endpoints import auth_url
+from profiler import StageProfiler
+from tokenmanager import TokenManager
+
 
 class Environment(Enum):
     DEV = "SYSTEM-DEV"
@@ -13,11 +17,16 @@ class Environment(Enum):
 
 
 class Authenticator:
-    def __init__(self, client_id: str, client_secret: str, environment: Environment):
+    def __init__(self, client_id: str, client_secret: str, environment: Environment, http=None,
+                 token_cache: str = None, profiler: StageProfiler = None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.environment = environment
         self.token = None
+        self.http = http
+        # Token requests are timed as the profiler's 'auth' stage
+        fetch = profiler.wrap('auth', self.request_token) if profiler else self.request_token
+        self.token_manager = TokenManager(fetch, cache_path=token_cache, cache_key=f"{environment.value}:{client_id}")
 
     def url_suffix(self) -> str:
         if self.environment == Environment.PROD:
@@ -29,7 +38,24 @@ class Authenticator:
         return self.environment.value
 
     def authenticate(self):
-        url = f"https://SYSTEM-auth{self.url_suffix()}.COM/realms/{self.environment_realm()}/protocol/openid-connect/token"
+        self.token = self.token_manager.refresh()
+
+    def current_token(self) -> str:
+        """
+        Valid token for the next request, renewed ahead of its expiry and read from the token cache when enabled
+        """
+        self.token = self.token_manager.get()
+        return self.token
+
+    def renew(self, stale_token: str) -> str:
+        """
+        Renew after a 401; concurrent callers holding the same stale token trigger a single login
+        """
+        self.token = self.token_manager.invalidate(stale_token)
+        return self.token
+
+    def request_token(self):
+        url = f"{auth_url(self.url_suffix())}/realms/{self.environment_realm()}/protocol/openid-connect/token"
         print(f"Authenticating with URL: {url}")
         response = self.request_post_data(url)
 
@@ -37,13 +63,16 @@ class Authenticator:
             response_data = json.loads(response.text)
             access_token = response_data.get('access_token', '')
             if access_token:
-                self.token = f"Bearer {access_token}"
+                token = f"Bearer {access_token}"
+                expires_in = response_data.get('expires_in')
                 print('Authenticated Successfully!')
-                logging.info(f'Authenticated Successfully with token: {self.token}')
+                logging.info(f'Authenticated Successfully with token: {token}')
+                return token, time.time() + float(expires_in) if expires_in else None
             else:
                 error_msg = 'Access token not found in the response.'
                 print(error_msg)
                 logging.error(error_msg)
+                return None, None
         elif response.status_code == 400:
             error_msg = 'Authentication failed: Status code 400'
             print(error_msg)
@@ -61,5 +90,10 @@ class Authenticator:
         authorization = base64.b64encode(bytes(f"{self.client_id}:{self.client_secret}", "ISO-8859-1")).decode("ascii")
         headers = {"Authorization": f"Basic {authorization}", "Content-Type": "application/x-www-form-urlencoded"}
         body = {"grant_type": "client_credentials"}
-        response = requests.post(url, data=body, headers=headers)
+        if self.http:
+            post = self.http.post
+        else:
+            import requests
+            post = requests.post
+        response = post(url, data=body, headers=headers)
         return response
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the SYSTEM login, OIDC token, client (create and search) and identifier endpoints, used by
+run_bench.py.
+
+Point the tools at it with SYSTEMCLI_SERVICE_URL, SYSTEMCLI_AUTH_URL and SYSTEMCLI_GATEWAY_URL set to the URL
+printed at startup.
+"""
+import argparse
+import base64
+import gzip
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+IDENTIFIERS_PATH = re.compile(r'^/system-client/clients/([^/]+)/identifiers$')
+TOKEN_PATH = re.compile(r'^/realms/[^/]+/protocol/openid-connect/token$')
+NAME_FIELDS = ('firstname', 'lastname', 'fantasyName')
+
+
+class MockSystem:
+    """
+    Shared state and fault injection settings of the mock server
+    """
+
+    def __init__(self, latency_ms=20.0, jitter_ms=5.0, error_rate=0.0, rate_429=0.0, retry_after=1,
+                 token_ttl=300, rate_502=0.0, rate_missing_client=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.token_ttl = token_ttl
+        self.rate_502 = rate_502
+        # Share of client ids answered with 404 on the identifiers endpoint, always the same ones
+        self.rate_missing_client = rate_missing_client
+
+        self.ids = itertools.count(1)
+        self.tokens = {}
+        # Search key -> ids of the clients created with it
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.status_counts = {}
+        self.durations = []
+
+    def issue_token(self):
+        expires_at = time.time() + self.token_ttl
+        claims = base64.urlsafe_b64encode(json.dumps({'exp': int(expires_at)}).encode()).decode().rstrip('=')
+        token = f"mock.{claims}.{next(self.ids)}"
+        with self.lock:
+            self.tokens[token] = expires_at
+        return token
+
+    def token_valid(self, authorization):
+        token = (authorization or '').split(' ')[-1]
+        with self.lock:
+            expires_at = self.tokens.get(token)
+        return expires_at is not None and time.time() < expires_at
+
+    def add_client(self, client):
+        client_id = next(self.ids)
+        keys = [('name',) + tuple(str(client.get(field) or '') for field in NAME_FIELDS)]
+        keys += [('identifier', str(i.get('code')), str(i.get('value'))) for i in client.get('identifiers', [])]
+        with self.lock:
+            for key in keys:
+                self.clients.setdefault(key, []).append(client_id)
+        return client_id
+
+    def client_missing(self, client_id):
+        return zlib.crc32(client_id.encode()) % 10000 < self.rate_missing_client * 10000
+
+    def search(self, query):
+        params = {name: values[0] for name, values in parse_qs(query).items()}
+        if 'identifierCode' in params:
+            key = ('identifier', params['identifierCode'], params.get('identifierValue', ''))
+        else:
+            key = ('name',) + tuple(params.get(field, '') for field in NAME_FIELDS)
+        page, size = int(params.get('page', 0)), int(params.get('size', 100))
+        with self.lock:
+            ids = list(self.clients.get(key, []))
+        content = [{'id': client_id} for client_id in ids[page * size:(page + 1) * size]]
+        return {'content': content, 'last': (page + 1) * size >= len(ids)}
+
+    def record(self, status, duration):
+        with self.lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self.durations.append(duration)
+
+    def stats(self, reset=False):
+        with self.lock:
+            durations = sorted(self.durations)
+            status_counts = dict(self.status_counts)
+            if reset:
+                self.durations = []
+                self.status_counts = {}
+
+        def percentile(p):
+            if not durations:
+                return None
+            return durations[min(len(durations) - 1, int(len(durations) * p))]
+
+        return {
+            'requests': len(durations),
+            'status_counts': status_counts,
+            'p50_ms': None if not durations else percentile(0.50) * 1000,
+            'p99_ms': None if not durations else percentile(0.99) * 1000,
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body leave in a single segment; avoids Nagle/delayed-ACK stalls on keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        start = time.monotonic()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        status, payload, headers = self.route(body)
+        self.reply(status, payload, headers)
+        self.server.system.record(status, time.monotonic() - start)
+
+    def do_GET(self):
+        start = time.monotonic()
+        status, payload, headers = self.route(None)
+        self.reply(status, payload, headers)
+        self.server.system.record(status, time.monotonic() - start)
+
+    def route(self, body):
+        """
+        body is None for a GET
+        """
+        system = self.server.system
+        path, _, query = self.path.partition('?')
+
+        if path == '/system/rest/v2/login':
+            return 200, system.issue_token(), {}
+        if TOKEN_PATH.match(path):
+            return 200, {'access_token': system.issue_token(), 'expires_in': system.token_ttl}, {}
+
+        identifiers = IDENTIFIERS_PATH.match(path)
+        if path != '/system-client/clients' and not identifiers or body is None and identifiers:
+            return 404, {'detail': 'Not found'}, {}
+
+        if system.latency_ms:
+            time.sleep(max(0.0, random.gauss(system.latency_ms, system.jitter_ms)) / 1000)
+        if not system.token_valid(self.headers.get('Authorization')):
+            return 401, {'detail': 'Token expired'}, {}
+        if random.random() < system.rate_429:
+            return 429, {'detail': 'Too many requests'}, {'Retry-After': str(system.retry_after)}
+        if random.random() < system.rate_502:
+            return 502, 'Bad Gateway', {}
+        if random.random() < system.error_rate:
+            return 500, {'detail': 'Injected error'}, {}
+        if body is None:
+            return 200, system.search(query), {}
+
+        try:
+            data = json.loads(body or b'{}')
+        except ValueError:
+            return 400, {'detail': 'Invalid JSON'}, {}
+        if identifiers and system.client_missing(identifiers.group(1)):
+            return 404, {'detail': f'Client {identifiers.group(1)} not found'}, {}
+        if identifiers:
+            return 201, {'identifier_id': next(system.ids), 'code': data.get('code'), 'value': data.get('value')}, {}
+        return 201, {'id': system.add_client(data.get('client', {}))}, {}
+
+    def reply(self, status, payload, headers):
+        if isinstance(payload, str):
+            content, content_type = payload.encode(), 'text/plain'
+        else:
+            content, content_type = json.dumps(payload).encode(), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, system, host='127.0.0.1', port=0):
+        super().__init__((host, port), MockHandler)
+        self.system = system
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def add_fault_arguments(parser):
+    parser.add_argument("--latency-ms", dest="latency_ms", type=float, default=20.0)
+    parser.add_argument("--jitter-ms", dest="jitter_ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0.0)
+    parser.add_argument("--rate-429", dest="rate_429", type=float, default=0.0)
+    parser.add_argument("--retry-after", dest="retry_after", type=int, default=1)
+    parser.add_argument("--token-ttl", dest="token_ttl", type=int, default=300)
+    parser.add_argument("--rate-502", dest="rate_502", type=float, default=0.0)
+    parser.add_argument("--rate-missing-client", dest="rate_missing_client", type=float, default=0.0)
+
+
+def system_from_args(args):
+    return MockSystem(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                      rate_429=args.rate_429, retry_after=args.retry_after, token_ttl=args.token_ttl,
+                      rate_502=args.rate_502, rate_missing_client=args.rate_missing_client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock SYSTEM gateway and auth server")
+    parser.add_argument("--port", type=int, default=8089)
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockServer(system_from_args(args), port=args.port)
+    print(f"Mock SYSTEM listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
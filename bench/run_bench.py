@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for systemclicreate.py and systemcliaddidentifier.py against the local mock SYSTEM.
+
+Generates input files of the requested sizes, runs each tool as a subprocess pointed at mock_system.py and
+reports rows/sec, peak RSS and the p50/p99 latency seen by the mock gateway.
+
+    python bench/run_bench.py --sizes 1000,100000 --workers 16 --latency-ms 30 --rate-429 0.01
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_system import MockServer, add_fault_arguments, system_from_args
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOOLS = {
+    'create': 'systemclicreate.py',
+    'addidentifier': 'systemcliaddidentifier.py',
+}
+
+
+def generate_clients(path, rows):
+    with open(path, 'w', newline='') as f:
+        f.write("client_firstname;client_surname;client_fantasy_name;"
+                "client_identifiers[0].code;client_identifiers[0].value\n")
+        for i in range(rows):
+            f.write(f"First{i};Last{i};Fantasy {i};NIF;{i:09d}\n")
+
+
+def generate_identifiers(path, rows):
+    with open(path, 'w', newline='') as f:
+        f.write("ID;CODE;VALUE\n")
+        for i in range(rows):
+            f.write(f"{i % 50000 + 1};EXT;{i:09d}\n")
+
+
+GENERATORS = {
+    'create': generate_clients,
+    'addidentifier': generate_identifiers,
+}
+
+
+def tool_arguments(tool, args):
+    if tool == 'create':
+        extra = ['--workers', str(args.workers), '--processes', str(args.processes)]
+    else:
+        extra = ['--max-in-flight', str(args.workers)]
+    return extra + args.extra.split()
+
+
+def run_tool(tool, input_filename, output_filename, args, url, log_filename):
+    env = dict(os.environ,
+               SYSTEMCLI_SERVICE_URL=url,
+               SYSTEMCLI_GATEWAY_URL=url,
+               SYSTEMCLI_AUTH_URL=url)
+    command = [sys.executable, os.path.join(ROOT, TOOLS[tool]),
+               '-i', input_filename, '-o', output_filename,
+               '-u', 'bench', '-p', 'bench', '-env', 'test'] + tool_arguments(tool, args)
+
+    with open(log_filename, 'w') as log:
+        start = time.monotonic()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=ROOT)
+        # wait4 returns the resource usage of this run only (ru_maxrss is in KB on Linux)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return elapsed, usage.ru_maxrss / 1024, process.returncode
+
+
+def run(args):
+    sizes = [int(size) for size in args.sizes.split(',')]
+    tools = list(TOOLS) if args.tool == 'both' else [args.tool]
+
+    system = system_from_args(args)
+    server = MockServer(system).start()
+    print(f"Mock SYSTEM listening on {server.url}\n")
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for tool in tools:
+            for size in sizes:
+                input_filename = os.path.join(workdir, f"{tool}_{size}.csv")
+                output_filename = os.path.join(workdir, f"{tool}_{size}_result.csv")
+                GENERATORS[tool](input_filename, size)
+
+                system.stats(reset=True)
+                elapsed, peak_rss_mb, exit_code = run_tool(tool, input_filename, output_filename, args, server.url,
+                                                           os.path.join(workdir, f"{tool}_{size}.log"))
+                stats = system.stats()
+                result = {
+                    'tool': tool,
+                    'rows': size,
+                    'seconds': round(elapsed, 3),
+                    'rows_per_second': round(size / elapsed, 1) if elapsed else None,
+                    'peak_rss_mb': round(peak_rss_mb, 1),
+                    'gateway_p50_ms': stats['p50_ms'] and round(stats['p50_ms'], 2),
+                    'gateway_p99_ms': stats['p99_ms'] and round(stats['p99_ms'], 2),
+                    'requests': stats['requests'],
+                    'status_counts': stats['status_counts'],
+                    'exit_code': exit_code,
+                }
+                results.append(result)
+                print_result(result)
+
+    server.shutdown()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+    return results
+
+
+def print_result(result):
+    print(f"{result['tool']:<14} {result['rows']:>9} rows  {result['seconds']:>9.2f}s  "
+          f"{result['rows_per_second'] or 0:>9.1f} rows/s  RSS {result['peak_rss_mb']:>7.1f} MB  "
+          f"p50 {result['gateway_p50_ms'] or 0:>7.2f} ms  p99 {result['gateway_p99_ms'] or 0:>7.2f} ms  "
+          f"requests {result['requests']:>9}  {result['status_counts']}"
+          f"{'' if result['exit_code'] == 0 else '  exit ' + str(result['exit_code'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the SYSTEM command line tools against a local mock")
+    parser.add_argument("--tool", choices=['create', 'addidentifier', 'both'], default='both')
+    parser.add_argument("--sizes", default='1000,100000,1000000', help="Comma separated row counts")
+    parser.add_argument("--workers", type=int, default=16, help="--workers / --max-in-flight passed to the tools")
+    parser.add_argument("--processes", type=int, default=1, help="--processes passed to systemclicreate.py")
+    parser.add_argument("--extra", default='', help="Extra arguments passed verbatim to the tools")
+    parser.add_argument("--workdir", default=None, help="Directory for the generated files (default: system temp)")
+    parser.add_argument("--json", default=None, help="Also write the results to this JSON file")
+    add_fault_arguments(parser)
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
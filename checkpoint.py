@@ -0,0 +1,113 @@
+import json
+import os
+from collections import deque
+
+from resultwriter import ResultRow
+
+
+def _json_default(value):
+    # numpy scalars coming from pandas rows
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class CheckpointJournal:
+    """
+    Append-only per-row journal keyed by input file line.
+
+    Every processed row is written as one JSON line and flushed immediately, so a crash or Ctrl-C loses at most
+    the row being written. Entries from later runs are appended after earlier ones; the last entry for a line wins.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def open(self, resume=False):
+        self.file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+        return self
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, row):
+        entry = {
+            'input_file_line': row.get('input_file_line'),
+            'result_status': row.get('result_status'),
+            'row': row
+        }
+        self.file.write(json.dumps(entry, default=_json_default) + '\n')
+        self.file.flush()
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash is simply processed again
+                    continue
+
+    def created_rows(self):
+        """
+        Yield the result row of every entry journaled as created
+        """
+        for entry in self.entries():
+            if entry.get('result_status') == 'created':
+                yield entry['row']
+
+
+class RestoredRows:
+    """
+    The rows earlier runs journaled as created, kept by --resume: merge() puts them back among the new results by
+    input line, so a resumed output stays in input order. They are held in memory, sorted by line, until merged.
+    """
+
+    def __init__(self, rows=()):
+        self.rows = deque(rows)
+        self.lines = {row.input_file_line for row in self.rows}
+
+    @classmethod
+    def from_journal(cls, journal, input_columns):
+        rows = {}
+        for row in journal.created_rows():
+            line = row['input_file_line']
+            if line not in rows:
+                rows[line] = ResultRow(tuple(row.get(column) for column in input_columns), line, 'created',
+                                       row.get('id'), row.get('response'), row.get('error_message'))
+        return cls(rows[line] for line in sorted(rows))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def take(self, end_line=None):
+        """
+        The rows before input line end_line (all of them without one), removed from those still to merge
+        """
+        rows = []
+        while self.rows and (end_line is None or self.rows[0].input_file_line < end_line):
+            rows.append(self.rows.popleft())
+        return rows
+
+    def merge(self, rows):
+        """
+        rows, new results in input order, with the restored rows that precede each of them put in their place
+        """
+        if not self.rows:
+            return rows
+        merged = []
+        for row in rows:
+            merged.extend(self.take(row.input_file_line))
+            merged.append(row)
+        return merged
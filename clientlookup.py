@@ -0,0 +1,155 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Client search: GET on the clients collection, filtered by identifier or by names, paginated with page/size
+LOOKUP_PATH = '/system-client/clients'
+PAGE_SIZE = 100
+MAX_PAGES = 10
+
+IDENTIFIER_PARAMS = ('identifierCode', 'identifierValue')
+# Query parameter -> payload field
+NAME_PARAMS = {
+    'firstname': 'firstname',
+    'lastname': 'lastname',
+    'fantasyName': 'fantasyName',
+}
+
+
+def page_items(data):
+    """
+    Items of a search response, either a plain list or a page object ('content' / 'items')
+    """
+    if isinstance(data, list):
+        return data
+    return data.get('content') or data.get('items') or []
+
+
+class TooManyMatches(Exception):
+    """
+    The search still had pages left after MAX_PAGES: ids holds the matches of the pages read, not all of them
+    """
+
+    def __init__(self, ids):
+        super().__init__(f"More than {len(ids)} clients match; the lookup stopped after {MAX_PAGES} pages")
+        self.ids = ids
+
+
+class LRUCache:
+    """
+    Bounded thread-safe LRU map with single-flight loading: concurrent load() calls for the same key run the
+    loader once and share its result. Failed loads are not cached.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def load(self, key, loader):
+        """
+        Return (value, loaded): loaded is True only for the caller that ran loader()
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key], False
+            future = self.loading.get(key)
+            owner = future is None
+            if owner:
+                future = self.loading[key] = Future()
+                self.misses += 1
+        if not owner:
+            return future.result(), False
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self._put(key, value)
+            del self.loading[key]
+        future.set_result(value)
+        return value, True
+
+
+class ClientLookup:
+    """
+    Resolves create payloads to the ids of existing clients, by their first identifier or else by their names.
+
+    search(params) performs one GET and returns the response; results are cached per key, so repeated rows in a
+    file cost one lookup.
+    """
+
+    def __init__(self, search, cache_size=10000):
+        self.search = search
+        self.cache = LRUCache(cache_size)
+
+    def key(self, payload):
+        client = payload.get('client', {})
+        for identifier in client.get('identifiers', []):
+            return 'identifier', str(identifier['code']).strip(), str(identifier['value']).strip()
+        names = tuple(str(client.get(field) or '').strip() for field in NAME_PARAMS.values())
+        if any(names):
+            return ('name',) + names
+        return None
+
+    def params(self, key):
+        if key[0] == 'identifier':
+            return dict(zip(IDENTIFIER_PARAMS, key[1:]))
+        return {param: value for param, value in zip(NAME_PARAMS, key[1:]) if value}
+
+    def find(self, key):
+        """
+        Ids of the clients matching key, from the cache or the API
+        """
+        return self.cache.load(key, lambda: self.fetch(key))[0]
+
+    def fetch(self, key):
+        """
+        Ids of the clients matching key, from the API. TooManyMatches is raised rather than returning a partial list
+        when MAX_PAGES pages are not enough
+        """
+        ids = []
+        for page in range(MAX_PAGES):
+            response = self.search(dict(self.params(key), page=page, size=PAGE_SIZE))
+            if response.status_code == 404:
+                break
+            if response.status_code != 200:
+                raise Exception(f"Lookup failed. Status code: {response.status_code}, Detail: {response.text}")
+            data = response.json()
+            items = page_items(data)
+            ids.extend(str(item['id']) for item in items if item.get('id') is not None)
+            if len(items) < PAGE_SIZE or (isinstance(data, dict) and data.get('last')):
+                break
+        else:
+            raise TooManyMatches(ids)
+        return ids
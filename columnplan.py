@@ -0,0 +1,76 @@
+def clean_value(value):
+    """
+    Same rules as SystemCliBase.get_value: NaN, None and '' become None
+    """
+    if value is None or value != value or value == '':  # NaN is the only value not equal to itself
+        return None
+    return value
+
+
+class ColumnPlan:
+    """
+    Mapping from input columns to payload fields and identifier slots, compiled once per file.
+
+    fields maps a dotted payload path (e.g. 'client.firstname') to a column name. identifiers maps a dotted
+    payload path to a column prefix; the slots '<prefix>[i].code' / '<prefix>[i].value' found in the file become
+    a list of {"code", "value"} objects. Columns missing from the file are dropped from the plan.
+    """
+
+    def __init__(self, columns, fields=None, identifiers=None, max_identifiers=3):
+        self.columns = list(columns)
+        positions = {column: i for i, column in enumerate(self.columns)}
+        self.positions = positions
+
+        self.fields = [
+            (tuple(path.split('.')), positions[column])
+            for path, column in (fields or {}).items()
+            if column in positions
+        ]
+
+        self.identifiers = []
+        for path, prefix in (identifiers or {}).items():
+            slots = []
+            for i in range(max_identifiers):
+                code_column = f"{prefix}[{i}].code"
+                value_column = f"{prefix}[{i}].value"
+                if code_column in positions and value_column in positions:
+                    slots.append((positions[code_column], positions[value_column]))
+            if slots:
+                self.identifiers.append((tuple(path.split('.')), slots))
+
+    def has_column(self, column):
+        return column in self.positions
+
+    def position(self, column):
+        return self.positions[column]
+
+    def rows(self, chunk):
+        """
+        Yield (index, values) for every row of the chunk, values being a plain tuple in column order
+        """
+        return zip(chunk.index, chunk.itertuples(index=False, name=None))
+
+    def build(self, values):
+        payload = {}
+        for path, position in self.fields:
+            value = clean_value(values[position])
+            if value is not None:
+                self._set(payload, path, value)
+
+        for path, slots in self.identifiers:
+            identifiers = []
+            for code_position, value_position in slots:
+                code = clean_value(values[code_position])
+                value = clean_value(values[value_position])
+                if code and value:
+                    identifiers.append({"code": code, "value": value})
+            if identifiers:
+                self._set(payload, path, identifiers)
+        return payload
+
+    @staticmethod
+    def _set(payload, path, value):
+        target = payload
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        target[path[-1]] = value
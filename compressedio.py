@@ -0,0 +1,47 @@
+import gzip
+import io
+import os
+
+# File extension -> compression, for the input and output files
+COMPRESSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+
+
+def compression(filename):
+    """
+    'gzip', 'zstd' or None, from the file extension
+    """
+    return COMPRESSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def base_name(filename):
+    """
+    filename without its compression extension, e.g. to pick the output format of 'result.jsonl.gz'
+    """
+    return os.path.splitext(filename)[0] if compression(filename) else filename
+
+
+def open_binary(filename, mode='rb', fileobj=None):
+    """
+    Open a file for reading ('rb') or writing ('wb'), (de)compressing on the fly according to its extension.
+    With fileobj, that already open file is read / written instead of opening filename; the caller closes it
+    """
+    kind = compression(filename)
+    if kind == 'gzip':
+        # A low level keeps compression from slowing down the writer thread on big outputs
+        return gzip.GzipFile(filename=None if fileobj else filename, mode=mode, compresslevel=3, fileobj=fileobj)
+    if kind == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("Zstandard files need the zstandard package: pip install zstandard")
+        return zstandard.open(fileobj or filename, mode, closefd=fileobj is None)
+    return fileobj or open(filename, mode)
+
+
+def open_text(filename, mode='r', encoding='utf-8', newline=None):
+    if not compression(filename):
+        return open(filename, mode, encoding=encoding, newline=newline)
+    return io.TextIOWrapper(open_binary(filename, mode[0] + 'b'), encoding=encoding, newline=newline)
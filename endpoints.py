@@ -0,0 +1,18 @@
+import os
+
+# Base URLs can be overridden (e.g. to run against a local mock gateway); the path part is always appended.
+SERVICE_URL_VARIABLE = 'SYSTEMCLI_SERVICE_URL'
+GATEWAY_URL_VARIABLE = 'SYSTEMCLI_GATEWAY_URL'
+AUTH_URL_VARIABLE = 'SYSTEMCLI_AUTH_URL'
+
+
+def service_url(url_suffix):
+    return os.environ.get(SERVICE_URL_VARIABLE, f"https://system-service{url_suffix}.com").rstrip('/')
+
+
+def gateway_url(url_suffix):
+    return os.environ.get(GATEWAY_URL_VARIABLE, f"https://system-gateway{url_suffix}.com").rstrip('/')
+
+
+def auth_url(url_suffix):
+    return os.environ.get(AUTH_URL_VARIABLE, f"https://SYSTEM-auth{url_suffix}.COM").rstrip('/')
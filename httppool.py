@@ -0,0 +1,115 @@
+import gzip
+import json
+import time
+
+from profiler import StageProfiler
+
+# JSON bodies smaller than this are sent as they are even with compress_requests: gzip would not pay off
+GZIP_MIN_BYTES = 256
+
+
+class HttpPool:
+    """
+    Shared keep-alive HTTP session with a bounded connection pool, used by every SYSTEM call path.
+    When metrics is set, every request is recorded there (latency, status code and body size).
+    With compress_requests, JSON bodies are sent gzip compressed (Content-Encoding: gzip).
+    With an enabled profiler, encoding the JSON bodies and the requests themselves are timed as the 'encode' and
+    'http' stages.
+    """
+
+    def __init__(self, pool_size: int = 10, timeout: float = 60, retries: int = 3, backoff_factor: float = 0.5,
+                 keep_alive: bool = True, metrics=None, compress_requests: bool = False, profiler=None):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.keep_alive = keep_alive
+        self.metrics = metrics
+        self.compress_requests = compress_requests
+        self.profiler = profiler or StageProfiler()
+        self._session = None
+
+    @property
+    def session(self):
+        # Built on first use: requests is only imported by runs that actually call SYSTEM
+        if self._session is None:
+            self._session = self.create_session()
+        return self._session
+
+    def create_session(self):
+        # Only connection errors are retried at this level: the POSTs are not idempotent, so a request that
+        # reached the gateway must not be replayed blindly.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=0,
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry,
+                              pool_block=True)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if kwargs.get('json') is not None:
+            with self.profiler.stage('encode'):
+                self.encode_json(kwargs)
+        with self.profiler.stage('http'):
+            if not self.metrics:
+                return self.session.request(method, url, **kwargs)
+
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except Exception:
+                self.metrics.observe(url, 'connection_error', time.monotonic() - start)
+                raise
+        body = response.request.body
+        self.metrics.observe(url, response.status_code, time.monotonic() - start, len(body) if body else 0)
+        return response
+
+    def encode_json(self, kwargs):
+        """
+        Replace the json argument by its encoded body, as requests would do it, gzip compressed with
+        compress_requests
+        """
+        body = json.dumps(kwargs.pop('json'), allow_nan=False).encode('utf-8')
+        headers = dict(kwargs.get('headers') or {})
+        headers.setdefault('Content-Type', 'application/json')
+        if self.compress_requests and len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+        kwargs['data'] = body
+        kwargs['headers'] = headers
+
+    def share(self, metrics=None, compress_requests=False, profiler=None):
+        """
+        A pool on the same session and connections that records to its own metrics and profiler, e.g. for each job
+        of the server; the session stays this pool's, so only this one is closed
+        """
+        pool = HttpPool(self.pool_size, self.timeout, self.retries, self.backoff_factor, self.keep_alive,
+                        metrics=metrics, compress_requests=compress_requests, profiler=profiler)
+        pool._session = self.session
+        return pool
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
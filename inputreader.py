@@ -0,0 +1,341 @@
+import csv
+import io
+import os
+import re
+from contextlib import ExitStack, contextmanager
+
+from compressedio import compression, open_binary, open_text
+
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm')
+
+# CSV inputs smaller than this are parsed with the csv module; pandas is only imported for larger files
+PANDAS_MIN_BYTES = 4 * 1024 * 1024
+
+# A line holding only whitespace, which pd.read_csv skips: it is no row, and gets no row number
+BLANK_LINE = re.compile(rb'^[ \t\r\f\v]*\n', re.MULTILINE)
+
+
+def is_excel(filename):
+    return filename.lower().endswith(EXCEL_EXTENSIONS)
+
+
+def count_lines(filepath, start=0, end=None):
+    """
+    Count newline characters by scanning the raw file in 1 MB blocks, optionally within a byte range. Compressed
+    files are decompressed on the fly and always scanned whole
+    """
+    def count_generator(reader, remaining):
+        b = reader(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+        while b:
+            yield b
+            if remaining is not None:
+                remaining -= len(b)
+                if remaining <= 0:
+                    return
+            b = reader(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+
+    if compression(filepath):
+        with open_binary(filepath) as fp:
+            return sum(buffer.count(b'\n') for buffer in count_generator(fp.read, None))
+
+    with open(filepath, 'rb') as fp:
+        fp.seek(start)
+        c_generator = count_generator(fp.raw.read, None if end is None else end - start)
+        count = sum(buffer.count(b'\n') for buffer in c_generator)
+    return count
+
+
+def shard_ranges(filepath, shards):
+    """
+    Split the data part of a CSV (everything after the header line) into at most `shards` byte ranges that start
+    and end on line boundaries. Quoted fields spanning several lines and compressed files are not supported.
+    """
+    size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as fp:
+        fp.readline()
+        bounds = [fp.tell()]
+        for i in range(1, shards):
+            target = bounds[0] + (size - bounds[0]) * i // shards
+            if target <= bounds[-1]:
+                continue
+            # Starting one byte early keeps a target that already follows a newline where it is
+            fp.seek(target - 1)
+            fp.readline()
+            if bounds[-1] < fp.tell() < size:
+                bounds.append(fp.tell())
+        bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def count_range_rows(filepath, start, end):
+    """
+    Number of rows in a byte range produced by shard_ranges: its lines less the blank ones the readers skip, so the
+    shards number their rows as a single pass over the file does
+    """
+    rows = 0
+    with open_range(filepath, start, end) as fp:
+        while True:
+            # Completed to the end of its last line, so that no line is split between two blocks
+            block = fp.read(1024 * 1024) + fp.readline()
+            if not block:
+                return rows
+            rows += block.count(b'\n') - len(BLANK_LINE.findall(block))
+            if not block.endswith(b'\n') and block.rsplit(b'\n', 1)[-1].strip():
+                rows += 1
+
+
+class ByteRangeReader(io.RawIOBase):
+    """
+    Raw reader exposing only the [start, end) bytes of a file
+    """
+
+    def __init__(self, filepath, start, end):
+        self.file = open(filepath, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            return 0
+        view = memoryview(buffer)[:min(len(buffer), self.remaining)]
+        n = self.file.readinto(view)
+        self.remaining -= n
+        return n
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def open_range(filepath, start, end):
+    return io.BufferedReader(ByteRangeReader(filepath, start, end), 1024 * 1024)
+
+
+class InputProgress:
+    """
+    How far read_chunks got through the input: file bytes consumed (compressed bytes for .gz / .zst) and rows
+    parsed. The total row count is estimated from them while the file is read, so nothing has to scan it first;
+    the estimate becomes exact once the end is reached.
+    """
+
+    def __init__(self, filename):
+        self.size = os.path.getsize(filename)
+        self.bytes_read = 0
+        self.rows_read = 0
+        self.expected_rows = None
+        self.finished = False
+
+    def estimated_rows(self):
+        if self.finished:
+            return self.rows_read
+        if self.expected_rows is not None:
+            return self.expected_rows
+        if not self.rows_read or not self.bytes_read:
+            return None
+        return max(self.rows_read, round(self.rows_read * self.size / self.bytes_read))
+
+
+class CountingReader(io.RawIOBase):
+    """
+    Raw reader of a whole file keeping InputProgress.bytes_read up to date
+    """
+
+    def __init__(self, filepath, progress):
+        self.file = open(filepath, 'rb')
+        self.progress = progress
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.file.readinto(buffer)
+        self.progress.bytes_read += n
+        return n
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+@contextmanager
+def open_input(filename, progress=None):
+    """
+    Binary stream of the (decompressed) CSV data, counting the file bytes consumed into progress
+    """
+    with ExitStack() as stack:
+        raw = None
+        if progress is not None:
+            raw = stack.enter_context(io.BufferedReader(CountingReader(filename, progress), 64 * 1024))
+        yield stack.enter_context(open_binary(filename, fileobj=raw))
+
+
+class TextChunk:
+    """
+    Plain-tuple stand-in for a DataFrame chunk, exposing what ColumnPlan and the tools use (columns, index and
+    itertuples), so small inputs and spreadsheets do not need pandas
+    """
+
+    def __init__(self, columns, rows, index):
+        self.columns = columns
+        self.rows = rows
+        self.index = index
+
+    def __len__(self):
+        return len(self.rows)
+
+    def itertuples(self, index=False, name=None):
+        return iter(self.rows)
+
+
+def column_names(header):
+    # Same names pandas gives to blank header cells
+    return [str(col) if col not in (None, '') else f'Unnamed: {i}' for i, col in enumerate(header)]
+
+
+def read_header(filename, sep=';'):
+    """
+    Column names of a CSV or of the first sheet of a workbook
+    """
+    if is_excel(filename):
+        from openpyxl import load_workbook
+        workbook = load_workbook(filename, read_only=True, data_only=True)
+        try:
+            header = next(workbook.active.iter_rows(values_only=True), None)
+        finally:
+            workbook.close()
+    else:
+        with open_text(filename, 'r', encoding='utf-8-sig', newline='') as f:
+            header = next(csv.reader(f, delimiter=sep), None)
+    return column_names(header or [])
+
+
+def count_rows(filename):
+    """
+    Number of data rows (header excluded) without loading the file
+    """
+    if is_excel(filename):
+        from openpyxl import load_workbook
+        workbook = load_workbook(filename, read_only=True, data_only=True)
+        try:
+            max_row = workbook.active.max_row or 0
+        finally:
+            workbook.close()
+        return max(0, max_row - 1)
+
+    if compression(filename):
+        lines = 0
+        last = b''
+        with open_binary(filename) as fp:
+            for block in iter(lambda: fp.read(1024 * 1024), b''):
+                lines += block.count(b'\n')
+                last = block[-1:]
+        if last and last != b'\n':
+            lines += 1
+        return max(0, lines - 1)
+
+    lines = count_lines(filename)
+    with open(filename, 'rb') as fp:
+        fp.seek(0, 2)
+        if fp.tell() == 0:
+            return 0
+        fp.seek(-1, 2)
+        if fp.read(1) != b'\n':
+            lines += 1
+    return max(0, lines - 1)
+
+
+def read_chunks(filename, chunksize=1000, sep=';', progress=None):
+    """
+    Yield the input as DataFrames (or TextChunks) of at most chunksize rows, indexed by data row number across
+    chunks. .gz / .zst CSV files are decompressed while they are read. progress (an InputProgress) is kept up to
+    date as the file is consumed
+    """
+    if is_excel(filename):
+        if progress is not None:
+            # The sheet dimension is known upfront and the bytes of a zipped workbook say little
+            progress.expected_rows = count_rows(filename)
+        chunks = read_excel_chunks(filename, chunksize)
+    elif os.path.getsize(filename) < PANDAS_MIN_BYTES:
+        chunks = read_text_chunks(filename, chunksize, sep, progress)
+    else:
+        chunks = read_pandas_chunks(filename, chunksize, sep, progress)
+    for chunk in chunks:
+        if progress is not None:
+            progress.rows_read += len(chunk)
+        yield chunk
+    if progress is not None:
+        progress.finished = True
+
+
+def read_pandas_chunks(filename, chunksize=1000, sep=';', progress=None):
+    import pandas as pd
+    # Read every cell as text so codes such as '00123' reach the API unchanged
+    if progress is None and not compression(filename):
+        yield from pd.read_csv(filename, sep=sep, chunksize=chunksize, dtype=str, index_col=False)
+        return
+    with open_input(filename, progress) as f:
+        yield from pd.read_csv(f, sep=sep, chunksize=chunksize, dtype=str, index_col=False, encoding='utf-8-sig')
+
+
+def read_text_chunks(filename, chunksize=1000, sep=';', progress=None):
+    """
+    csv module version of read_chunks for CSV files: text cells, empty cells as None and blank (whitespace only)
+    lines skipped, like pd.read_csv(dtype=str)
+    """
+    with open_input(filename, progress) as stream, io.TextIOWrapper(stream, encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f, delimiter=sep)
+        header = next(reader, None)
+        if header is None:
+            return
+        columns = column_names(header)
+
+        width = len(columns)
+        padding = [''] * width
+        position = 0
+        index = []
+        buffer = []
+        for values in reader:
+            if not values or (len(values) == 1 and not values[0].strip()):
+                continue
+            index.append(position)
+            position += 1
+            buffer.append(tuple(value if value != '' else None for value in (values + padding)[:width]))
+            if len(buffer) >= chunksize:
+                yield TextChunk(columns, buffer, index)
+                index = []
+                buffer = []
+        if buffer:
+            yield TextChunk(columns, buffer, index)
+
+
+def read_excel_chunks(filename, chunksize=1000):
+    # read_only mode streams the sheet XML instead of building the whole workbook in memory
+    from openpyxl import load_workbook
+    workbook = load_workbook(filename, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = column_names(header)
+
+        width = len(columns)
+        index = []
+        buffer = []
+        for position, values in enumerate(rows):
+            if all(value is None for value in values):
+                continue
+            # Keep the sheet position so input_file_line still points at the spreadsheet row
+            index.append(position)
+            buffer.append((tuple(values) + (None,) * width)[:width])
+            if len(buffer) >= chunksize:
+                yield TextChunk(columns, buffer, index)
+                index = []
+                buffer = []
+        if buffer:
+            yield TextChunk(columns, buffer, index)
+    finally:
+        workbook.close()
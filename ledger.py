@@ -0,0 +1,64 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def normalize(value):
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    return value
+
+
+class IdempotencyLedger:
+    """
+    Local SQLite record of the payloads already applied to SYSTEM, so overlapping files are not sent twice.
+
+    Keys are a SHA-256 of the operation, the environment and the normalized payload (which, for identifiers,
+    includes the client id). Every record is committed at once, so no write transaction stays open: several
+    processes can share one ledger, waiting up to busy_timeout seconds for each other's writes.
+    """
+
+    def __init__(self, path, environment, busy_timeout=60):
+        self.path = path
+        self.environment = str(environment)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS applied ("
+            "key TEXT PRIMARY KEY, operation TEXT NOT NULL, result_id TEXT, applied_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def key(self, operation, payload):
+        normalized = json.dumps(normalize(payload), sort_keys=True, separators=(',', ':'), ensure_ascii=False,
+                                default=str)
+        return hashlib.sha256(f"{operation}|{self.environment}|{normalized}".encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        """
+        Return (True, result_id) when the key was already applied, (False, None) otherwise
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT result_id FROM applied WHERE key = ?", (key,)).fetchone()
+        return (True, row[0]) if row else (False, None)
+
+    def record(self, key, operation, result_id=None):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO applied (key, operation, result_id, applied_at) VALUES (?, ?, ?, ?)",
+                (key, operation, None if result_id is None else str(result_id), time.time())
+            )
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
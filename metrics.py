@@ -0,0 +1,264 @@
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Path segments carrying a record id (numeric or UUID), collapsed so endpoints stay a small label set
+ID_SEGMENT = re.compile(r'/(?:\d+|[0-9a-fA-F]{8}-[0-9a-fA-F-]{27}|[0-9a-fA-F]{32})(?=/|$)')
+
+
+def endpoint_name(url):
+    return ID_SEGMENT.sub('/{id}', urlsplit(url).path) or '/'
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram, cheap to update and to merge across processes
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, counts=None, total=0.0):
+        self.buckets = tuple(buckets)
+        self.counts = list(counts) if counts else [0] * (len(self.buckets) + 1)
+        self.total = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+
+    def quantile(self, q):
+        """
+        Estimate of the q quantile, interpolated inside the bucket that holds it
+        """
+        count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.total}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['buckets'], data['counts'], data['sum'])
+
+
+class RunMetrics:
+    """
+    Per-run counters for cron dashboards: request latency histograms, status codes and bytes sent per endpoint,
+    retries by reason and result rows by status.
+
+    With json_path and/or prometheus_path set, start() exports a snapshot every interval seconds and stop() writes
+    the final one. The Prometheus file follows the node_exporter textfile collector format. Both files are replaced
+    atomically so a reader never sees a partial write.
+    """
+
+    def __init__(self, tool, json_path=None, prometheus_path=None, interval=30):
+        self.tool = tool
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.started_at = time.time()
+        self.finished = False
+        self.succeeded = None
+        self.endpoints = {}
+        self.retries = {}
+        self.rows = {}
+        # Latest request and retry counters of other processes (e.g. shards), by source
+        self.sources = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.json_path or self.prometheus_path)
+
+    def observe(self, url, status, latency, bytes_sent=0):
+        endpoint = endpoint_name(url)
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {'latency': Histogram(), 'status_counts': {}, 'bytes_sent': 0}
+            stats['latency'].observe(latency)
+            stats['status_counts'][str(status)] = stats['status_counts'].get(str(status), 0) + 1
+            stats['bytes_sent'] += bytes_sent
+
+    def retry(self, reason):
+        with self.lock:
+            self.retries[reason] = self.retries.get(reason, 0) + 1
+
+    def row(self, status, count=1):
+        with self.lock:
+            self.rows[status] = self.rows.get(status, 0) + count
+
+    def merge_requests(self, source, snapshot):
+        """
+        Count the request and retry counters of another process' snapshot (rows are counted by the caller). Snapshots
+        are cumulative, so a later one of the same source replaces the earlier.
+        """
+        with self.lock:
+            self.sources[source] = {'requests': snapshot['requests'], 'retries': snapshot['retries']}
+
+    def combined(self):
+        """
+        Copies of the endpoint stats and retries of this process plus the latest ones of every source; call with
+        the lock held
+        """
+        endpoints = {endpoint: {'latency': Histogram(stats['latency'].buckets, stats['latency'].counts,
+                                                     stats['latency'].total),
+                                'status_counts': dict(stats['status_counts']),
+                                'bytes_sent': stats['bytes_sent']}
+                     for endpoint, stats in self.endpoints.items()}
+        retries = dict(self.retries)
+        for source in self.sources.values():
+            for endpoint, other in source['requests'].items():
+                stats = endpoints.get(endpoint)
+                if stats is None:
+                    stats = endpoints[endpoint] = {'latency': Histogram(), 'status_counts': {}, 'bytes_sent': 0}
+                stats['latency'].merge(Histogram.from_dict(other['latency']))
+                for status, count in other['status_counts'].items():
+                    stats['status_counts'][status] = stats['status_counts'].get(status, 0) + count
+                stats['bytes_sent'] += other['bytes_sent']
+            for reason, count in source['retries'].items():
+                retries[reason] = retries.get(reason, 0) + count
+        return endpoints, retries
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.started_at
+            rows = dict(self.rows)
+            endpoints, retries = self.combined()
+            requests = {}
+            for endpoint, stats in endpoints.items():
+                latency = stats['latency']
+                requests[endpoint] = {
+                    'count': latency.count,
+                    'status_counts': dict(stats['status_counts']),
+                    'bytes_sent': stats['bytes_sent'],
+                    'latency_p50_seconds': latency.quantile(0.50),
+                    'latency_p90_seconds': latency.quantile(0.90),
+                    'latency_p99_seconds': latency.quantile(0.99),
+                    'latency': latency.to_dict(),
+                }
+            return {
+                'tool': self.tool,
+                'started_at': self.started_at,
+                'updated_at': now,
+                'elapsed_seconds': elapsed,
+                'finished': self.finished,
+                'succeeded': self.succeeded,
+                'rows': rows,
+                'rows_per_second': sum(rows.values()) / elapsed if elapsed > 0 else 0.0,
+                'retries': retries,
+                'requests': requests,
+            }
+
+    def start(self):
+        if not self.enabled or self.thread:
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.export()
+
+    def stop(self, succeeded=True):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self.finished = True
+        self.succeeded = succeeded
+        self.export()
+
+    def export(self):
+        if not self.enabled:
+            return
+        snapshot = self.snapshot()
+        try:
+            if self.json_path:
+                self.write_atomic(self.json_path, json.dumps(snapshot, indent=2))
+            if self.prometheus_path:
+                self.write_atomic(self.prometheus_path, self.prometheus_text(snapshot))
+        except OSError as e:
+            print(f"\nCould not write metrics: {e}")
+
+    def write_atomic(self, path, content):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def prometheus_text(self, snapshot):
+        tool = f'tool="{self.tool}"'
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{{{','.join([tool] + labels)}}} {value}")
+
+        requests = snapshot['requests']
+        metric('systemcli_requests_total', 'counter', 'HTTP requests sent, by endpoint and status code.',
+               [([f'endpoint="{endpoint}"', f'status="{status}"'], count)
+                for endpoint, stats in requests.items() for status, count in stats['status_counts'].items()])
+        metric('systemcli_request_bytes_sent_total', 'counter', 'Request body bytes sent, by endpoint.',
+               [([f'endpoint="{endpoint}"'], stats['bytes_sent']) for endpoint, stats in requests.items()])
+
+        histogram_samples = []
+        for endpoint, stats in requests.items():
+            latency = stats['latency']
+            cumulative = 0
+            for bound, count in zip(list(latency['buckets']) + ['+Inf'], latency['counts']):
+                cumulative += count
+                histogram_samples.append(('_bucket', [f'endpoint="{endpoint}"', f'le="{bound}"'], cumulative))
+            histogram_samples.append(('_sum', [f'endpoint="{endpoint}"'], latency['sum']))
+            histogram_samples.append(('_count', [f'endpoint="{endpoint}"'], cumulative))
+        lines.append("# HELP systemcli_request_duration_seconds HTTP request latency, by endpoint.")
+        lines.append("# TYPE systemcli_request_duration_seconds histogram")
+        for suffix, labels, value in histogram_samples:
+            lines.append(f"systemcli_request_duration_seconds{suffix}{{{','.join([tool] + labels)}}} {value}")
+
+        metric('systemcli_retries_total', 'counter', 'Requests sent again, by reason.',
+               [([f'reason="{reason}"'], count) for reason, count in snapshot['retries'].items()])
+        metric('systemcli_rows_total', 'counter', 'Input rows processed, by result status.',
+               [([f'status="{status}"'], count) for status, count in snapshot['rows'].items()])
+        metric('systemcli_rows_per_second', 'gauge', 'Average rows processed per second since the start.',
+               [([], snapshot['rows_per_second'])])
+        metric('systemcli_run_start_timestamp_seconds', 'gauge', 'Start time of the run.',
+               [([], snapshot['started_at'])])
+        metric('systemcli_run_last_update_timestamp_seconds', 'gauge', 'Time this snapshot was written.',
+               [([], snapshot['updated_at'])])
+        metric('systemcli_run_finished', 'gauge', '1 once the run has ended.',
+               [([], int(snapshot['finished']))])
+        if snapshot['succeeded'] is not None:
+            metric('systemcli_run_success', 'gauge', '1 if the run ended without an error.',
+                   [([], int(snapshot['succeeded']))])
+        return '\n'.join(lines) + '\n'
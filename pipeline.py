@@ -0,0 +1,121 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+STOP = object()
+
+
+def resolve(result):
+    while isinstance(result, Future):
+        result = result.result()
+    return result
+
+
+def map_ordered(func, items, workers=1, backlog=0):
+    """
+    Apply func to each item on a bounded thread pool, yielding results in input order.
+
+    func may return a Future (e.g. a deferred retry); its result is yielded in the item's place, and up to
+    backlog further items keep being processed while it is pending
+    """
+    if workers <= 1 and not backlog:
+        for item in items:
+            yield resolve(func(item))
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            # Keep a bounded window in flight so memory does not grow with the input size
+            if len(pending) >= workers * 2 + backlog:
+                yield resolve(pending.popleft().result())
+        while pending:
+            yield resolve(pending.popleft().result())
+
+
+class Pipeline:
+    """
+    reader -> transform -> send -> write, with the stages running at the same time.
+
+    The reader iterates source (e.g. the chunks of read_chunks) on its own thread and the transform turns those into
+    the items to send (transform(iterable) -> iterable) on another; each hands its output to the next stage through
+    a bounded queue (read_ahead chunks, queue_size items). run() sends the items on a pool of workers with
+    map_ordered and passes the results, in input order, to write on the calling thread; write should only hand
+    them on (e.g. to a ResultWriter) so the network stage is never held up by the disk. When the gateway slows down
+    the queues fill up and the reader waits, so memory stays bounded.
+
+    Iterating the pipeline instead of calling run() yields the transformed items, for senders of their own. An error
+    in any stage stops the others and is raised to the caller.
+    """
+
+    def __init__(self, source, transform=None, read_ahead=4, queue_size=1000):
+        self.source = source
+        self.transform = transform or (lambda items: items)
+        self.read_queue = queue.Queue(maxsize=read_ahead)
+        self.send_queue = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.error = None
+        self.threads = []
+
+    def __iter__(self):
+        self.start()
+        try:
+            yield from self.drain(self.send_queue)
+        finally:
+            self.stop()
+
+    def run(self, send, write, workers=1, backlog=0):
+        try:
+            for result in map_ordered(send, self, workers, backlog):
+                write(result)
+        finally:
+            self.stop()
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self.feed, args=(lambda: self.source, self.read_queue), daemon=True),
+            threading.Thread(target=self.feed, args=(lambda: self.transform(self.drain(self.read_queue)),
+                                                     self.send_queue), daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def feed(self, items, out):
+        try:
+            for item in items():
+                if not self.put(out, item):
+                    return
+        except BaseException as e:
+            if self.error is None:
+                self.error = e
+        self.put(out, STOP)
+
+    def put(self, out, item):
+        # Time out now and then so a stage blocked on a full queue notices when the pipeline is stopped
+        while not self.stopping.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(self, source):
+        while not self.stopping.is_set():
+            try:
+                item = source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is STOP:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
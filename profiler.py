@@ -0,0 +1,168 @@
+import cProfile
+import pstats
+import threading
+import time
+
+
+class _NoStage:
+    """
+    What stage() returns when profiling is off: entering and leaving it does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_STAGE = _NoStage()
+
+
+class _Stage:
+
+    __slots__ = ('profiler', 'name', 'wall', 'cpu')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.dump_path:
+            self.profiler.profile_thread()
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, time.perf_counter() - self.wall, time.thread_time() - self.cpu)
+        return False
+
+
+class StageProfiler:
+    """
+    Wall and CPU time spent per stage of a run (reading the file, building payloads, encoding, HTTP, ...).
+
+    Code paths mark their stages with `with profiler.stage(name):`, iterate(name, items) or wrap(name, func). When
+    the profiler is disabled these return a shared no-op context manager, the items and the function themselves,
+    so the hooks can stay in the hot paths. CPU time is that of the thread running the stage; stages running on
+    different threads overlap, so their wall times can add up to more than the run's. A nested stage is counted in
+    both (e.g. the login request of 'auth' is part of 'http' too).
+
+    With dump_path set, every thread entering a stage is also profiled with cProfile and the merged pstats are
+    written there by stop().
+    """
+
+    def __init__(self, enabled=False, dump_path=None, quiet=False):
+        self.enabled = enabled or bool(dump_path)
+        self.dump_path = dump_path
+        # Collect only, e.g. in a shard whose totals are printed by the parent
+        self.quiet = quiet
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles = []
+        self.started_at = None
+        self.started_cpu = None
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else NO_STAGE
+
+    def iterate(self, name, items):
+        """
+        items, timing every step of the iteration (e.g. parsing the next chunk of the file) as stage name
+        """
+        return self._iterate(name, items) if self.enabled else items
+
+    def _iterate(self, name, items):
+        items = iter(items)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def wrap(self, name, func):
+        if not self.enabled:
+            return func
+
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return timed
+
+    def add(self, name, wall, cpu, calls=1):
+        with self.lock:
+            totals = self.stages.get(name)
+            if totals is None:
+                totals = self.stages[name] = [0, 0.0, 0.0]
+            totals[0] += calls
+            totals[1] += wall
+            totals[2] += cpu
+
+    def totals(self):
+        """
+        {stage: (calls, wall seconds, cpu seconds)}, e.g. to send a shard's stages to the parent
+        """
+        with self.lock:
+            return {name: tuple(totals) for name, totals in self.stages.items()}
+
+    def merge(self, totals):
+        for name, (calls, wall, cpu) in totals.items():
+            self.add(name, wall, cpu, calls)
+
+    def profile_thread(self):
+        # cProfile follows the thread it is enabled on, so each thread gets its own; they are merged by stop()
+        if getattr(self.local, 'profile', None) is not None:
+            return
+        profile = cProfile.Profile()
+        self.local.profile = profile
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+: the profiler enabled on the main thread already covers every thread
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.started_at = time.perf_counter()
+        self.started_cpu = time.process_time()
+        if self.dump_path:
+            self.profile_thread()
+
+    def stop(self):
+        if not self.enabled or self.started_at is None:
+            return
+        wall = time.perf_counter() - self.started_at
+        cpu = time.process_time() - self.started_cpu
+        self.started_at = None
+        if self.dump_path:
+            self.dump()
+        if not self.quiet:
+            self.print_report(wall, cpu)
+
+    def dump(self):
+        with self.lock:
+            profiles, self.profiles = self.profiles, []
+        for profile in profiles:
+            profile.disable()
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(self.dump_path)
+        print(f"\ncProfile statistics written to {self.dump_path} (python -m pstats {self.dump_path})")
+
+    def print_report(self, wall, cpu):
+        print("\nProfile (seconds; stages on different threads overlap):")
+        print(f"  {'stage':<10} {'calls':>10} {'wall':>10} {'cpu':>10} {'wall/call ms':>14}")
+        for name, (calls, stage_wall, stage_cpu) in sorted(self.totals().items(), key=lambda item: -item[1][1]):
+            print(f"  {name:<10} {calls:>10} {stage_wall:>10.2f} {stage_cpu:>10.2f} "
+                  f"{stage_wall * 1000 / calls if calls else 0:>14.3f}")
+        print(f"  {'run':<10} {'':>10} {wall:>10.2f} {cpu:>10.2f}")
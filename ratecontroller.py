@@ -0,0 +1,119 @@
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header (delta-seconds or HTTP-date) into seconds to wait
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateController:
+    """
+    Additive-increase/multiplicative-decrease limit on the number of requests in flight.
+
+    The limit grows by one request per round of successful responses and is cut by decrease_factor when the
+    gateway answers 429/503, a request fails at the connection level, or the smoothed latency climbs above
+    latency_factor times the best latency observed so far.
+    """
+
+    def __init__(self, max_limit: int = 1, min_limit: int = 1, initial_limit: int = None,
+                 decrease_factor: float = 0.5, latency_factor: float = 3.0, throttle_retries: int = 5,
+                 default_retry_after: float = 1.0, metrics=None):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        if initial_limit is None:
+            initial_limit = max(self.min_limit, self.max_limit // 2)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.throttle_retries = throttle_retries
+        self.default_retry_after = default_retry_after
+        self.metrics = metrics
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.latency_ewma = None
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self.condition.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, status_code=None, latency=None, retry_after=None):
+        with self.condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+
+            congested = status_code is None or status_code in THROTTLE_STATUS_CODES
+            if latency is not None and status_code is not None:
+                self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+                if self.best_latency is None or self.latency_ewma < self.best_latency:
+                    self.best_latency = self.latency_ewma
+                if self.latency_ewma > self.latency_factor * self.best_latency:
+                    congested = True
+
+            if status_code in THROTTLE_STATUS_CODES:
+                pause = retry_after if retry_after is not None else self.default_retry_after
+                self.paused_until = max(self.paused_until, now + pause)
+
+            if congested:
+                # Cut at most once per smoothed round-trip so a burst of throttled responses counts as one signal
+                if now - self.last_decrease >= (self.latency_ewma or 0.0):
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+            self.condition.notify_all()
+
+    def call(self, func):
+        """
+        Run func() under the controller, waiting and retrying while the gateway throttles the request
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            start = time.monotonic()
+            try:
+                response = func()
+            except Exception:
+                self.release(None, time.monotonic() - start)
+                raise
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After')) \
+                if response.status_code in THROTTLE_STATUS_CODES else None
+            self.release(response.status_code, time.monotonic() - start, retry_after)
+
+            if response.status_code not in THROTTLE_STATUS_CODES or attempt >= self.throttle_retries:
+                return response
+            attempt += 1
+            if self.metrics:
+                self.metrics.retry('throttled')
+
+    def current_limit(self):
+        return int(self.limit)
@@ -0,0 +1,360 @@
+import csv
+import json
+import os
+import queue
+import shutil
+import threading
+from array import array
+
+from columnplan import clean_value
+from compressedio import base_name, compression, open_binary, open_text
+from profiler import StageProfiler
+
+OUTPUT_FORMATS = {
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.parquet': 'parquet',
+}
+
+# Columns stored as integers in Parquet; all the others are text
+INTEGER_COLUMNS = ('input_file_line',)
+
+# Result statuses, kept as one byte per row until written
+STATUSES = ('created', 'skipped_duplicate', 'validation_error', 'error', 'found', 'multiple_matches', 'not_found')
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+# Fields a result adds to the input values
+RESULT_FIELDS = ('input_file_line', 'result_status', 'id', 'response', 'error_message')
+
+# Distinct error messages shared between the rows of a writer; new ones beyond this are kept per row
+MESSAGE_CACHE_SIZE = 10000
+
+
+def output_format(filename):
+    """
+    'csv', 'jsonl' or 'parquet', from the output file extension (after a .gz / .zst one)
+    """
+    return OUTPUT_FORMATS.get(os.path.splitext(base_name(filename))[1].lower(), 'csv')
+
+
+def to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return str(value)
+
+
+class MessageCache:
+    """
+    The error messages of one run's rows, so rows failing the same way (e.g. every row of a client SYSTEM does not
+    know) share one string. It lives as long as its ResultWriter, so runs in the same process share nothing.
+    """
+
+    def __init__(self, size=MESSAGE_CACHE_SIZE):
+        self.size = size
+        self.messages = {}
+
+    def intern(self, message):
+        """
+        The copy of message already held by an earlier row
+        """
+        if not isinstance(message, str):
+            return message
+        cached = self.messages.get(message)
+        if cached is not None:
+            return cached
+        if len(self.messages) < self.size:
+            self.messages[message] = message
+        return message
+
+
+class ResultRow:
+    """
+    Result of one input row: the row's values tuple (shared with the reader, not copied) plus the result fields
+    """
+
+    __slots__ = ('values',) + RESULT_FIELDS
+
+    def __init__(self, values, input_file_line, result_status, id=None, response=None, error_message=None):
+        self.values = values
+        self.input_file_line = input_file_line
+        self.result_status = result_status
+        self.id = id
+        self.response = response
+        self.error_message = error_message
+
+    def to_dict(self, columns):
+        """
+        Input values by column name plus the result fields, e.g. for the journal
+        """
+        row = dict(zip(columns, self.values))
+        for field in RESULT_FIELDS:
+            value = getattr(self, field)
+            if value is not None or field not in row:
+                row[field] = value
+        return row
+
+
+class ResultColumns:
+    """
+    A batch of results stored by column: the values tuples of the input rows, input lines in an int64 array,
+    statuses as one byte each (STATUSES) and the id / response / error message columns, the messages interned in
+    messages. The output columns are joined from these only when the batch is written.
+
+    Result dicts (rows restored from the journal) are accepted too and split into the same columns.
+    """
+
+    def __init__(self, columns, input_columns=None, messages=None):
+        if input_columns is None:
+            input_columns = [column for column in columns if column not in RESULT_FIELDS]
+        self.columns = columns
+        self.input_columns = list(input_columns)
+        positions = {column: i for i, column in enumerate(self.input_columns)}
+        # Per output column: position in the input values and / or result field it comes from
+        self.sources = [(positions.get(column), column if column in RESULT_FIELDS else None) for column in columns]
+        self.values = []
+        self.lines = array('q')
+        self.statuses = bytearray()
+        self.ids = []
+        self.responses = []
+        self.errors = []
+        self.messages = messages or MessageCache()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def extend(self, rows):
+        for row in rows:
+            if isinstance(row, dict):
+                row = ResultRow(tuple(row.get(column) for column in self.input_columns), row['input_file_line'],
+                                row['result_status'], row.get('id'), row.get('response'), row.get('error_message'))
+            self.values.append(row.values)
+            self.lines.append(row.input_file_line)
+            self.statuses.append(STATUS_CODES[row.result_status])
+            self.ids.append(row.id)
+            self.responses.append(row.response)
+            self.errors.append(self.messages.intern(row.error_message))
+
+    def field(self, field):
+        if field == 'input_file_line':
+            return self.lines.tolist()
+        if field == 'result_status':
+            return [STATUSES[code] for code in self.statuses]
+        return {'id': self.ids, 'response': self.responses, 'error_message': self.errors}[field]
+
+    def column(self, position, field):
+        if field is None:
+            if position is None:
+                return [None] * len(self)
+            return [values[position] for values in self.values]
+        data = self.field(field)
+        if position is not None:
+            # An input column named like a result field keeps its value where the result leaves it unset
+            data = [value if value is not None else values[position] for value, values in zip(data, self.values)]
+        return data
+
+    def data(self):
+        """
+        The output columns as lists, in column order
+        """
+        return [self.column(position, field) for position, field in self.sources]
+
+    def rows(self):
+        return zip(*self.data())
+
+
+def write_csv_rows(filename, rows, columns, sep=',', header=False, append=True):
+    """
+    Write result dicts as CSV in the given column order; missing keys, None and NaN become empty cells
+    """
+    with open_text(filename, 'a' if append else 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter=sep, lineterminator=os.linesep)
+        if header:
+            writer.writerow(columns)
+        writer.writerows([clean_value(row.get(column)) for column in columns] for row in rows)
+
+
+class CsvSink:
+
+    def __init__(self, filename, columns, sep=',', header=True):
+        self.columns = columns
+        self.file = open_text(filename, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file, delimiter=sep, lineterminator=os.linesep)
+        if header:
+            self.writer.writerow(columns)
+
+    def write(self, batch):
+        self.writer.writerows([clean_value(value) for value in row] for row in batch.rows())
+        self.file.flush()
+
+    def append_file(self, filename):
+        self.file.flush()
+        with open(filename, 'rb') as part:
+            shutil.copyfileobj(part, self.file.buffer, 1024 * 1024)
+        self.file.buffer.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlSink(CsvSink):
+
+    def __init__(self, filename, columns, sep=None, header=None):
+        self.columns = columns
+        self.file = open_text(filename, 'w', encoding='utf-8', newline='\n')
+
+    def write(self, batch):
+        self.file.write(''.join(
+            json.dumps({column: clean_value(value) for column, value in zip(self.columns, row)}, ensure_ascii=False,
+                       default=str) + '\n'
+            for row in batch.rows()
+        ))
+        self.file.flush()
+
+
+class ParquetSink:
+
+    def __init__(self, filename, columns, sep=None, header=None):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("Parquet output needs the pyarrow package: pip install pyarrow")
+        self.pa = pa
+        self.pq = pq
+        self.columns = columns
+        self.schema = pa.schema([(column, pa.int64() if column in INTEGER_COLUMNS else pa.string())
+                                 for column in columns])
+        # Parquet compresses its pages itself; an extra .gz / .zst wraps the whole file
+        self.stream = open_binary(filename, 'wb') if compression(filename) else None
+        self.writer = pq.ParquetWriter(self.stream or filename, self.schema)
+
+    def write(self, batch):
+        data = {
+            column: [clean_value(value) if column in INTEGER_COLUMNS else to_text(clean_value(value))
+                     for value in values]
+            for column, values in zip(self.columns, batch.data())
+        }
+        # Each batch becomes one row group
+        self.writer.write_table(self.pa.Table.from_pydict(data, schema=self.schema))
+
+    def append_file(self, filename):
+        # A record batch at a time, so a shard's part is never loaded whole
+        with self.pq.ParquetFile(filename) as part:
+            for batch in part.iter_batches():
+                self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        if self.stream:
+            self.stream.close()
+
+
+SINKS = {
+    'csv': CsvSink,
+    'jsonl': JsonlSink,
+    'parquet': ParquetSink,
+}
+
+
+def open_sink(filename, columns, format=None, sep=',', header=True):
+    return SINKS[format or output_format(filename)](filename, columns, sep=sep, header=header)
+
+
+class ResultWriter:
+    """
+    Serializes result rows on a background thread so the request path only hands a list to a queue.
+
+    Rows (ResultRow, or result dicts) are buffered in a ResultColumns batch, input_columns naming the values of the
+    ResultRows, and written to the sink in batches of batch_size, or after flush_interval seconds without
+    new rows. The queue is bounded, so a slow disk slows the producers down instead of growing memory. A write
+    error is raised to the producer on its next write() or on close(). Sink writes are timed as the profiler's
+    'write' stage.
+    """
+
+    STOP = object()
+
+    def __init__(self, sink, input_columns=None, batch_size=1000, flush_interval=1.0, max_pending=1000,
+                 profiler=None):
+        self.sink = sink
+        self.input_columns = input_columns
+        self.profiler = profiler or StageProfiler()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.messages = MessageCache()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, rows):
+        if self.error:
+            raise self.error
+        if rows:
+            self.queue.put(list(rows))
+
+    def append_file(self, filename):
+        """
+        Append another file written in the same format (e.g. a shard's part) after the rows queued so far, then
+        remove it
+        """
+        if self.error:
+            raise self.error
+        self.queue.put(filename)
+
+    def close(self):
+        if self.thread:
+            self.queue.put(self.STOP)
+            self.thread.join()
+            self.thread = None
+        if self.error:
+            raise self.error
+
+    def new_batch(self):
+        return ResultColumns(self.sink.columns, self.input_columns, self.messages)
+
+    def flush(self, batch):
+        if not batch:
+            return batch
+        with self.profiler.stage('write'):
+            self.sink.write(batch)
+        return self.new_batch()
+
+    def run(self):
+        batch = self.new_batch()
+        stopped = False
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    batch = self.flush(batch)
+                    continue
+                if item is self.STOP:
+                    stopped = True
+                    break
+                if isinstance(item, str):
+                    batch = self.flush(batch)
+                    if os.path.exists(item):
+                        with self.profiler.stage('write'):
+                            self.sink.append_file(item)
+                        os.remove(item)
+                    continue
+                batch.extend(item)
+                if len(batch) >= self.batch_size:
+                    batch = self.flush(batch)
+            self.flush(batch)
+        except Exception as e:
+            self.error = e
+            # Keep consuming so producers blocked on a full queue are released
+            while not stopped:
+                stopped = self.queue.get() is self.STOP
+        finally:
+            self.sink.close()
@@ -0,0 +1,112 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Gateway answers worth sending again later; RateController already waits out 429/503 inline first
+TRANSIENT_STATUS_CODES = (429, 502, 503, 504)
+
+
+class TransientError(Exception):
+    """
+    A failure that may succeed if the same request is sent again later
+    """
+
+
+def is_transient(response):
+    return response.status_code in TRANSIENT_STATUS_CODES or getattr(response, 'transient', False)
+
+
+def is_transient_exception(exception):
+    import requests
+    return isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+class RetryQueue:
+    """
+    Deferred retries with jittered exponential backoff for transient failures.
+
+    defer(func, attempt) returns a Future at once, so the caller's worker moves on to fresh rows; func runs again on
+    the queue's own threads after a random delay of up to base_delay * 2**attempt seconds (capped at max_delay).
+    func returns the final result, or another Future when it deferred itself again. Callers stop deferring after
+    max_attempts retries and record the row as an error. backlog is how many rows the ordered output may hold
+    while waiting for deferred ones.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, workers=1, backlog=1000, metrics=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.workers = max(1, workers)
+        self.backlog = backlog
+        self.metrics = metrics
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = None
+        self.thread = None
+        self.closed = False
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def can_retry(self, attempt):
+        return attempt < self.max_attempts
+
+    def defer(self, func, attempt):
+        if self.metrics:
+            self.metrics.retry('transient')
+        future = Future()
+        with self.condition:
+            if self.thread is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (time.monotonic() + self.delay(attempt), next(self.sequence), func, future))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(timeout=self.heap[0][0] - time.monotonic() if self.heap else None)
+                if self.closed:
+                    return
+                _, _, func, future = heapq.heappop(self.heap)
+            self.executor.submit(self.execute, func, future)
+
+    @staticmethod
+    def execute(func, future):
+        try:
+            result = func()
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(lambda done: RetryQueue.chain(done, future))
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    def chain(done, future):
+        if done.exception() is not None:
+            future.set_exception(done.exception())
+        else:
+            future.set_result(done.result())
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        for _, _, _, future in self.heap:
+            future.cancel()
+        self.heap = []
@@ -0,0 +1,120 @@
+import re
+
+from inputreader import TextChunk
+from resultwriter import ResultRow
+
+INTEGER = re.compile(r'\d+')
+
+
+def is_blank(value):
+    return value is None or value != value or str(value).strip() == ''
+
+
+class RowValidator:
+    """
+    Row-level checks run on each input chunk before any request is sent.
+
+    required columns must not be empty, each (code, value) pair must be filled together or left empty together and
+    integer columns must hold a whole number when filled. Rules on columns missing from the file are ignored.
+    DataFrame chunks are checked with column operations; the small TextChunks are checked in plain Python.
+    """
+
+    def __init__(self, columns, required=(), pairs=(), integers=()):
+        positions = {column: i for i, column in enumerate(columns)}
+        self.required = [(column, positions[column]) for column in required if column in positions]
+        self.pairs = [(code, value, positions[code], positions[value]) for code, value in pairs
+                      if code in positions and value in positions]
+        self.integers = [(column, positions[column]) for column in integers if column in positions]
+
+    def errors(self, chunk):
+        """
+        {position in chunk: error message} for every invalid row of the chunk
+        """
+        if isinstance(chunk, TextChunk):
+            return self.text_errors(chunk.rows)
+        return self.frame_errors(chunk)
+
+    def text_errors(self, rows):
+        messages = {}
+
+        def add(position, message):
+            messages[position] = f"{messages[position]}; {message}" if position in messages else message
+
+        for column, i in self.required:
+            for position, values in enumerate(rows):
+                if is_blank(values[i]):
+                    add(position, f"{column} is empty")
+        for code, value, i, j in self.pairs:
+            for position, values in enumerate(rows):
+                if is_blank(values[i]) != is_blank(values[j]):
+                    add(position, f"{code} and {value} must be filled together")
+        for column, i in self.integers:
+            for position, values in enumerate(rows):
+                if not is_blank(values[i]) and not INTEGER.fullmatch(str(values[i]).strip()):
+                    add(position, f"{column} is not a number")
+        return messages
+
+    def frame_errors(self, chunk):
+        import numpy as np
+
+        messages = np.full(len(chunk), '', dtype=object)
+        text = {}
+
+        def stripped(column):
+            if column not in text:
+                text[column] = chunk[column].fillna('').astype(str).str.strip()
+            return text[column]
+
+        def add(mask, message):
+            mask = np.asarray(mask, dtype=bool)
+            messages[mask] = messages[mask] + f"; {message}"
+
+        for column, _ in self.required:
+            add(stripped(column) == '', f"{column} is empty")
+        for code, value, _, _ in self.pairs:
+            add((stripped(code) == '') != (stripped(value) == ''), f"{code} and {value} must be filled together")
+        for column, _ in self.integers:
+            values = stripped(column)
+            add((values != '') & ~values.str.fullmatch(INTEGER.pattern), f"{column} is not a number")
+
+        invalid = np.flatnonzero(messages != '')
+        return {int(position): messages[position][2:] for position in invalid}
+
+    def invalid_rows(self, chunk):
+        """
+        Yield (index, values, message) for the invalid rows of the chunk
+        """
+        errors = self.errors(chunk)
+        if not errors:
+            return
+        positions = sorted(errors)
+        if isinstance(chunk, TextChunk):
+            for position in positions:
+                yield chunk.index[position], chunk.rows[position], errors[position]
+        else:
+            selected = chunk.iloc[positions]
+            for position, index, values in zip(positions, selected.index,
+                                               selected.itertuples(index=False, name=None)):
+                yield index, values, errors[position]
+
+
+def validate_rows(chunks, validator, writer, output_filename, profiler):
+    """
+    --validate-only: check every row of chunks without calling SYSTEM and write the invalid ones with writer (closed
+    at the end). Returns the number of invalid rows
+    """
+    total = 0
+    invalid = 0
+    with writer:
+        for chunk in profiler.iterate('read', chunks):
+            total += len(chunk)
+            with profiler.stage('validate'):
+                rows = [ResultRow(row, index + 2, 'validation_error', error_message=message)
+                        for index, row, message in validator.invalid_rows(chunk)]
+            writer.write(rows)
+            invalid += len(rows)
+
+    print(f"\n{total} rows validated: {total - invalid} valid, {invalid} invalid.")
+    if invalid:
+        print(f"Invalid rows written to {output_filename}")
+    return invalid
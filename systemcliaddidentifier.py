@@ -1,13 +1,52 @@
 #!/usr/bin/env python3
-import pandas as pd
 import argparse
 import sys
-import requests
+from collections import namedtuple
 
 from Authenticator import Authenticator, Environment
+from checkpoint import CheckpointJournal, RestoredRows
+from clientlookup import LRUCache
+from columnplan import ColumnPlan
+from endpoints import gateway_url
+from httppool import HttpPool
+from inputreader import InputProgress, is_excel, read_chunks, read_header
+from ledger import IdempotencyLedger
+from metrics import RunMetrics
+from pipeline import Pipeline
+from profiler import StageProfiler
+from ratecontroller import RateController
+from resultwriter import ResultRow, ResultWriter, open_sink, write_csv_rows
+from retryqueue import RetryQueue, is_transient, is_transient_exception
+from rowvalidation import RowValidator, validate_rows
 from systemclibase import ProgressBar
 
 
+CHUNK_SIZE = 1000
+VALIDATION_CHUNK_SIZE = 10000
+# Consecutive rows of one client sent by the same worker at most
+CLIENT_GROUP_SIZE = 100
+
+# Payload field -> input column
+IDENTIFIER_FIELDS = {
+    'code': 'CODE',
+    'value': 'VALUE',
+}
+
+# Appended to the input columns in the output; 'response' holds the body returned by SYSTEM as JSON text, so the
+# output schema does not depend on the responses
+RESULT_COLUMNS = ['input_file_line', 'result_status', 'response', 'error_message']
+
+# Columns every row must fill, and those that must hold a whole number
+REQUIRED_COLUMNS = ['ID', 'CODE', 'VALUE']
+INTEGER_COLUMNS = ['ID']
+
+# Client ids remembered as missing (404), so their other rows fail without a request
+MISSING_CLIENTS_CACHE_SIZE = 100000
+
+# What missing_clients keeps of a 404 instead of the whole response: enough to build the error rows
+MissingClient = namedtuple('MissingClient', ['status_code', 'text'])
+
+
 def _map_environment(env_str):
     env_mapping = {
         'dev': Environment.DEV,
@@ -20,95 +59,260 @@ def _map_environment(env_str):
 
 class SystemCliAddIdentifier:
     def __init__(self, client_id=None, client_secret=None, input_filename=None,
-                 output_filename=None, environment='test'):
+                 output_filename=None, environment='test', max_in_flight=1, timeout=60, retries=3, resume=False,
+                 token_cache=None, ledger_path=None, metrics_json=None, metrics_prom=None, metrics_interval=30,
+                 validate_only=False, retry_attempts=5, compress_requests=False, http=None, authenticator=None,
+                 profile=False, profile_dump=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.input_filename = input_filename
         self.output_filename = output_filename
         self.environment = _map_environment(environment)
-        self.authenticator = None if not (client_id and client_secret) else \
-            Authenticator(client_id, client_secret, self.environment)
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self.retries = retries
+        self.resume = resume
+        self.validate_only = validate_only
+        self.compress_requests = compress_requests
+        self.ledger_path = ledger_path
+        # A pool and authenticator handed in (e.g. by the job server) are shared with other runs and kept open
+        self.http = http
+        self.owns_http = http is None
+        self.ledger = None
+        self.journal = None
+        self.writer = None
+        self.output_columns = None
+        self.column_plan = None
+        self.validator = None
+        self.metrics = RunMetrics('addidentifier', json_path=metrics_json, prometheus_path=metrics_prom,
+                                  interval=metrics_interval)
+        self.rate_controller = RateController(max_limit=self.max_in_flight, metrics=self.metrics)
+        self.retry_queue = RetryQueue(max_attempts=retry_attempts, workers=self.max_in_flight, metrics=self.metrics)
+        self.missing_clients = LRUCache(MISSING_CLIENTS_CACHE_SIZE)
+        self.profiler = StageProfiler(profile, profile_dump)
+        self.authenticator = authenticator
+        if authenticator is None and client_id and client_secret:
+            self.authenticator = Authenticator(client_id, client_secret, self.environment, token_cache=token_cache,
+                                               profiler=self.profiler)
 
     def __enter__(self):
+        if self.owns_http:
+            self.http = HttpPool(pool_size=max(10, self.max_in_flight), timeout=self.timeout, retries=self.retries,
+                                 metrics=self.metrics, compress_requests=self.compress_requests,
+                                 profiler=self.profiler)
+        else:
+            # Same connections, but the requests are counted in this run's metrics
+            self.http = self.http.share(metrics=self.metrics, compress_requests=self.compress_requests,
+                                        profiler=self.profiler)
+        self.metrics.start()
+        self.profiler.start()
+        if self.ledger_path:
+            self.ledger = IdempotencyLedger(self.ledger_path, self.environment.value)
         if self.authenticator:
-            self.authenticator.authenticate()
+            if self.owns_http:
+                # A shared authenticator keeps the pool of the run that created it
+                self.authenticator.http = self.http
+            try:
+                self.authenticator.current_token()
+            except Exception:
+                self.metrics.stop(succeeded=False)
+                raise
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        # sonarlint requires a comment here
-        pass
+        self.retry_queue.close()
+        self.metrics.stop(succeeded=exc_type is None)
+        self.profiler.stop()
+        if self.http and self.owns_http:
+            self.http.close()
+            self.http = None
+        if self.ledger:
+            self.ledger.close()
+            self.ledger = None
 
     def generate_example_excel(self):
-        data = {
-            'id': [1234],
-            'code': ['XPTO'],
-            'value': ['COD-for-XPTO'],
-        }
-        df = pd.DataFrame(data)
-        df.to_csv(self.output_filename, index=False)
+        columns = ['ID', 'CODE', 'VALUE']
+        example = {'ID': 1234, 'CODE': 'XPTO', 'VALUE': 'COD-for-XPTO'}
+        if is_excel(self.output_filename):
+            from openpyxl import Workbook
+            workbook = Workbook()
+            workbook.active.append(columns)
+            workbook.active.append([example[column] for column in columns])
+            workbook.save(self.output_filename)
+        else:
+            write_csv_rows(self.output_filename, [example], columns, sep=';', header=True, append=False)
         print(f"Example Excel file generated: {self.output_filename}")
 
     def execute(self):
+        if self.validate_only:
+            return self.execute_validate_only()
         print("Starting...")
-        df = pd.read_csv(self.input_filename, delimiter=';')
-        total_rows = len(df)
-        print(f"{total_rows} identifiers to be processed...")
+        # No pre-scan: the row count is estimated from the bytes read while the file is processed
+        input_progress = InputProgress(self.input_filename)
+        print(f"Processing {self.input_filename} ({input_progress.size / 1024 / 1024:.1f} MB)...")
         print()
-        progress_bar = ProgressBar(total_rows, length=35)
-
-        results = []
-        for index, row in df.iterrows():
-            id = row['id'.upper()]
-            identifier_data = {
-                "code": row['code'.upper()],
-                "value": row['value'.upper()]
-            }
-            response = self.add_identifier_call(id, identifier_data)
-            result_row = row.to_dict()
-            result_row['input_file_line'] = index + 2
+        self.prepare_columns(read_header(self.input_filename))
+        self.journal = CheckpointJournal(f"{self.output_filename}.journal")
+        with ProgressBar(length=35, rate_controller=self.rate_controller, input_progress=input_progress) \
+                as progress_bar, self.open_writer() as self.writer:
+            restored = RestoredRows()
+            if self.resume:
+                restored = RestoredRows.from_journal(self.journal, self.column_plan.columns)
+                print(f"Resuming: {len(restored)} identifiers already created.")
+                print()
+                progress_bar.resumed(len(restored))
+
+            with self.journal.open(resume=self.resume):
+                chunks = read_chunks(self.input_filename, CHUNK_SIZE, progress=input_progress)
+                self.process_rows(self.profiler.iterate('read', chunks), progress_bar, restored)
+            self.writer.write(restored.take())
+        progress_bar.print_final_stats()
+
+    def prepare_columns(self, columns):
+        self.column_plan = ColumnPlan(columns, IDENTIFIER_FIELDS)
+        self.validator = RowValidator(columns, REQUIRED_COLUMNS, integers=INTEGER_COLUMNS)
+        self.output_columns = list(columns) + [column for column in RESULT_COLUMNS if column not in columns]
 
+    def open_writer(self):
+        """
+        Background writer for the output file: CSV, or JSONL / Parquet by extension
+        """
+        return ResultWriter(open_sink(self.output_filename, self.output_columns), self.column_plan.columns,
+                            profiler=self.profiler)
+
+    def execute_validate_only(self):
+        """
+        Check every row without calling SYSTEM; the invalid rows are written to the output file.
+        Returns the number of invalid rows
+        """
+        self.prepare_columns(read_header(self.input_filename))
+        chunks = read_chunks(self.input_filename, VALIDATION_CHUNK_SIZE)
+        return validate_rows(chunks, self.validator, self.open_writer(), self.output_filename, self.profiler)
+
+    def plan_rows(self, chunks, done_lines):
+        """
+        Yield (index, values, client id, payload, validation error or None, already applied) for the rows not created
+        yet, validating chunk by chunk
+        """
+        id_position = self.column_plan.position('ID')
+        for chunk in chunks:
+            with self.profiler.stage('validate'):
+                errors = self.validator.errors(chunk)
+            for position, (index, row) in enumerate(self.column_plan.rows(chunk)):
+                if index + 2 in done_lines:
+                    continue
+                if position in errors:
+                    yield index, row, None, None, errors[position], False
+                    continue
+                id = str(row[id_position]).strip()
+                with self.profiler.stage('payload'):
+                    identifier_data = self.column_plan.build(row)
+                applied = bool(self.ledger) and self.ledger.lookup(self.ledger_key(id, identifier_data))[0]
+                yield index, row, id, identifier_data, None, applied
+
+    def group_rows(self, planned):
+        """
+        Consecutive planned rows of the same client, in lists of up to CLIENT_GROUP_SIZE: each list is sent by one
+        worker
+        """
+        group = []
+        for item in planned:
+            if group and (item[2] != group[-1][2] or len(group) >= CLIENT_GROUP_SIZE):
+                yield group
+                group = []
+            group.append(item)
+        if group:
+            yield group
+
+    def process_rows(self, chunks, progress_bar, restored):
+        """
+        Add the identifiers of the rows of chunks not restored on max_in_flight workers, journaling the results and
+        handing them to the writer in input order, merged with the restored rows that precede them. Reading,
+        planning, sending and writing overlap (see Pipeline)
+        """
+        def write(result_rows):
+            with self.profiler.stage('journal'):
+                for result_row in result_rows:
+                    self.journal.record(result_row.to_dict(self.column_plan.columns))
+            self.writer.write(restored.merge(result_rows))
+            for result_row in result_rows:
+                self.metrics.row(result_row.result_status)
+                progress_bar.update_status(result_row.result_status)
+
+        backlog = self.retry_queue.backlog if self.retry_queue.max_attempts else 0
+        Pipeline(chunks, lambda chunks: self.group_rows(self.plan_rows(chunks, restored.lines))).run(
+            self.send_rows, write, self.max_in_flight, backlog)
+
+    def send_rows(self, group, results=None, attempt=0):
+        """
+        Add the identifiers of a group of rows of one client one after the other, returning their result rows, or a
+        Future of them when a transient failure deferred the rest of the group to the retry queue. Once SYSTEM
+        answers 404 for the client, its other rows are answered from missing_clients without a request.
+        """
+        results = results or []
+        for index, row, id, identifier_data, validation_error, applied in group[len(results):]:
+            if validation_error:
+                # Rejected locally: no request is sent
+                results.append(ResultRow(row, index + 2, 'validation_error', error_message=validation_error))
+                continue
+            if applied:
+                # Already applied in a previous run
+                results.append(ResultRow(row, index + 2, 'skipped_duplicate'))
+                continue
+            response = self.missing_clients.get(id)
+            if response is None:
+                response = self.add_identifier_call(id, identifier_data)
+                if response.status_code == 404:
+                    self.missing_clients.put(id, MissingClient(response.status_code, response.text))
+                elif is_transient(response) and self.retry_queue.can_retry(attempt):
+                    return self.retry_queue.defer(lambda: self.send_rows(group, results, attempt + 1), attempt)
+            attempt = 0
             if response.status_code == 201:
-                result_row['result_status'] = 'created'
-                result_row.update(response.json())
-                progress_bar.id_created()
+                results.append(ResultRow(row, index + 2, 'created', response=response.text))
             else:
-                result_row['result_status'] = 'error'
-                result_row['error_message'] = response.text
+                results.append(ResultRow(row, index + 2, 'error', error_message=response.text))
                 print(f"Error processing ID {id} at line {index + 2}: {response.text}")
-                progress_bar.validation_error()
-            results.append(result_row)
-            # Checkpoint: Save the intermediate results every 100 records
-            if (index + 1) % 100 == 0:
-                pd.DataFrame(results).to_csv(self.output_filename, index=False)
-                print(f"Checkpoint: Saved progress at {index + 1} records.")
-
-        result_df = pd.DataFrame(results)
-        result_df.to_csv(self.output_filename, index=False)
-        progress_bar.print_final_stats()
+        return results
+
+    def ledger_key(self, id, identifier_data):
+        return self.ledger.key('add_identifier', {'client_id': str(id), **identifier_data})
+
+    def record_in_ledger(self, id, identifier_data):
+        # The identifier was added either way: a ledger failure must not turn the row into an error
+        try:
+            self.ledger.record(self.ledger_key(id, identifier_data), 'add_identifier', id)
+        except Exception as e:
+            print(f"\nCould not record identifier {identifier_data} of client {id} in the ledger: {e}")
 
     def add_identifier_call(self, id, identifier_data, attempt=0):
         url_suffix = self.authenticator.url_suffix() if self.authenticator.environment != Environment.PROD else ""
-        url = f"\nhttps://system-gateway{url_suffix}.com/system-client/clients/{id}/identifiers"
-        headers = {"Authorization": self.authenticator.token, "Content-Type": "application/json"}
+        url = f"{gateway_url(url_suffix)}/system-client/clients/{id}/identifiers"
+        token = self.authenticator.current_token()
+        headers = {"Authorization": token, "Content-Type": "application/json"}
         #print(f"\nURL: {url}")
+        import requests
         try:
-            response = requests.post(url, json=identifier_data, headers=headers)
+            response = self.rate_controller.call(lambda: self.http.post(url, json=identifier_data, headers=headers))
 
             if response.status_code == 401 and attempt == 0:
-                self.authenticator.authenticate()
+                self.metrics.retry('unauthorized')
+                self.authenticator.renew(token)
                 return self.add_identifier_call(id, identifier_data, attempt + 1)
+            if response.status_code == 201 and self.ledger:
+                self.record_in_ledger(id, identifier_data)
             return response
 
         except requests.exceptions.RequestException as e:
             class ErrorResponse:
-                def __init__(self, status_code, text):
+                def __init__(self, status_code, text, transient=False):
                     self.status_code = status_code
                     self.text = text
+                    self.transient = transient
 
                 def json(self):
                     return {"error": self.text}
 
-            return ErrorResponse(500, str(e))
+            return ErrorResponse(500, str(e), transient=is_transient_exception(e))
 
 
 def main():
@@ -128,15 +332,67 @@ def main():
         "           Generate an example Excel file. \n"
         "           This option can be used only with -o.\n\n"
         "       -i input_filename\n"
-        "           Input Excel file for the operation.\n\n"
+        "           Input file for the operation: an Excel workbook (.xlsx, first sheet) or a ';' separated CSV.\n"
+        "           The file is read in chunks, so memory does not grow with its size. A CSV ending with .gz or\n"
+        "           .zst is decompressed while it is read (.zst needs the zstandard package).\n\n"
         "       -o output_filename\n"
-        "           Output Excel file to be generated (will be overwritten if it already exists).\n\n"
+        "           Output file to be generated (will be overwritten if it already exists).\n"
+        "           Written as CSV with the input columns, input_file_line, result_status, the SYSTEM response\n"
+        "           (JSON text) and error_message; as JSON lines / Parquet when the name ends with .jsonl or\n"
+        "           .parquet (Parquet needs the pyarrow package). A further .gz or .zst extension compresses the\n"
+        "           file while it is written, e.g. result.csv.gz.\n\n"
         "       --client-id client_id\n"
         "           Client ID for authentication.\n\n"
         "       --client-secret client_secret\n"
         "           Client Secret for authentication.\n\n"
         "       -env environment\n"
         "Specify the environment to be used; options include 'prod', 'test' (default), 'qa', and 'dev'.\n\n"
+        "       --max-in-flight N\n"
+        "           Number of identifier requests sent at the same time, each by a worker thread (default 1).\n"
+        "           The tool backs off when the gateway answers 429/503 or slows down and ramps back up.\n"
+        "           Consecutive rows of the same ID are sent one after the other by one worker; once a client is\n"
+        "           not found (404), its remaining rows are reported as error without being sent.\n\n"
+        "       --resume\n"
+        "           Resume an interrupted run: rows journaled as created in output_filename.journal are\n"
+        "           kept and skipped, all other rows are processed again.\n\n"
+        "       --ledger path\n"
+        "           SQLite file recording every identifier added. Rows already in the ledger for the same client\n"
+        "           are not sent again and are reported as skipped_duplicate.\n\n"
+        "       --token-cache path\n"
+        "           Keep the access token in this file (readable only by you) so that runs started before it\n"
+        "           expires skip the login.\n\n"
+        "       --timeout seconds\n"
+        "           Timeout for each HTTP request (default 60).\n\n"
+        "       --retries N\n"
+        "           Number of retries on connection errors (default 3).\n\n"
+        "       --retry-attempts N\n"
+        "           Rows failing with a transient error (connection reset, timeout, 429, 502, 503, 504) are set aside\n"
+        "           and sent again up to N times (default 5) with a growing random delay, while the other rows go on.\n"
+        "           Only rows still failing after that are reported as error. Use 0 to disable. Note that a request\n"
+        "           that timed out or got a 504 may already have been applied by SYSTEM.\n\n"
+        "       --metrics-json path\n"
+        "           Write run metrics (request latency histograms per endpoint, status codes, bytes sent, retries\n"
+        "           and rows per result status) to this JSON file during and at the end of the run.\n\n"
+        "       --metrics-prom path\n"
+        "           Write the same metrics in Prometheus text format, e.g. for the node_exporter textfile\n"
+        "           collector.\n\n"
+        "       --metrics-interval seconds\n"
+        "           How often the metrics files are rewritten while the run is in progress (default 30).\n\n"
+        "       --gzip-requests\n"
+        "           Send request bodies of 256 bytes or more gzip compressed (Content-Encoding: gzip). Only use it\n"
+        "           when the gateway accepts compressed requests.\n\n"
+        "       --profile\n"
+        "           At the end of the run, print the wall and CPU time spent per stage: read (parsing the input),\n"
+        "           validate, payload (building the request bodies), encode (JSON / gzip), http (waiting for\n"
+        "           SYSTEM), auth (token requests), journal and write (the output file).\n\n"
+        "       --profile-dump path\n"
+        "           Same as --profile, and also write cProfile statistics of every thread to this file, to be read\n"
+        "           with python -m pstats.\n\n"
+        "       --validate-only\n"
+        "           Only check the rows (ID, CODE and VALUE filled, ID a whole number) without connecting to\n"
+        "           SYSTEM; the credentials are not needed. The invalid rows are written to output_filename and the\n"
+        "           exit status is 1 when there is any. In normal runs invalid rows are reported as\n"
+        "           validation_error without being sent.\n\n"
         "USAGE EXAMPLE\n"
         "       Generating an example Excel file\n"
         "       ./systemcliaddidentifier.py -e -o template.xlsx\n\n"
@@ -165,6 +421,20 @@ def main():
     parser.add_argument("-env", dest="environment", default='test',
                         choices=['prod', 'test', 'qa', 'dev'],
                         help=argparse.SUPPRESS)
+    parser.add_argument("--max-in-flight", dest="max_in_flight", type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument("--resume", dest="resume", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--ledger", dest="ledger_path", help=argparse.SUPPRESS)
+    parser.add_argument("--token-cache", dest="token_cache", help=argparse.SUPPRESS)
+    parser.add_argument("--timeout", dest="timeout", type=float, default=60, help=argparse.SUPPRESS)
+    parser.add_argument("--retries", dest="retries", type=int, default=3, help=argparse.SUPPRESS)
+    parser.add_argument("--retry-attempts", dest="retry_attempts", type=int, default=5, help=argparse.SUPPRESS)
+    parser.add_argument("--validate-only", dest="validate_only", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--gzip-requests", dest="compress_requests", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-json", dest="metrics_json", help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-prom", dest="metrics_prom", help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-interval", dest="metrics_interval", type=float, default=30, help=argparse.SUPPRESS)
+    parser.add_argument("--profile", dest="profile", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--profile-dump", dest="profile_dump", help=argparse.SUPPRESS)
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
@@ -177,6 +447,14 @@ def main():
             parser.error("-e must be used only with -o")
         with SystemCliAddIdentifier(output_filename=args.output_filename) as app:
             app.generate_example_excel()
+    elif args.validate_only:
+        if not all([args.input_filename, args.output_filename]):
+            parser.error("-i and -o must be specified with --validate-only")
+        with SystemCliAddIdentifier(input_filename=args.input_filename, output_filename=args.output_filename,
+                                    validate_only=True, profile=args.profile, profile_dump=args.profile_dump) as app:
+            invalid = app.execute()
+        if invalid:
+            sys.exit(1)
     else:
         if not all([args.input_filename, args.output_filename, args.client_id, args.client_secret]):
             parser.error("Client ID (-u or --client-id), Client Secret (-p or --client-secret), -i, and -o must be "
@@ -186,7 +464,20 @@ def main():
                 client_secret=args.client_secret,
                 input_filename=args.input_filename,
                 output_filename=args.output_filename,
-                environment=args.environment
+                environment=args.environment,
+                max_in_flight=args.max_in_flight,
+                timeout=args.timeout,
+                retries=args.retries,
+                retry_attempts=args.retry_attempts,
+                resume=args.resume,
+                token_cache=args.token_cache,
+                ledger_path=args.ledger_path,
+                metrics_json=args.metrics_json,
+                metrics_prom=args.metrics_prom,
+                metrics_interval=args.metrics_interval,
+                compress_requests=args.compress_requests,
+                profile=args.profile,
+                profile_dump=args.profile_dump
         ) as app:
             app.execute()
 
@@ -1,12 +1,23 @@
 import json
-import pandas as pd
-import requests as requests
 import time
 import sys
+import threading
+from collections import deque
 from colorama import Fore, init
 
+from endpoints import service_url
+from httppool import HttpPool
+from ledger import IdempotencyLedger
+from metrics import RunMetrics
+from pipeline import Pipeline
+from profiler import StageProfiler
+from ratecontroller import RateController
+from tokenmanager import TokenManager, jwt_expiry
+
 
 class SystemCliBase:
+    # 'tool' label of the exported run metrics
+    tool_name = 'systemcli'
 
     def str_to_bool(self, value):
         if isinstance(value, str):
@@ -18,11 +29,13 @@ class SystemCliBase:
             return False
 
     def get_value(self, value):
+        import pandas as pd
         if pd.isna(value) or value == '':
             return None
         return value
 
     def get_identifiers(self, row, base_key):
+        import pandas as pd
         identifiers = []
         for i in range(3):
             key_code = f"{base_key}[{i}].code"
@@ -37,7 +50,9 @@ class SystemCliBase:
         return identifiers
 
     def __init__(self, username=None, password=None, input_filename=None, output_filename=None, environment='test',
-                 lookup_only=False):
+                 lookup_only=False, pool_size=10, timeout=60, retries=3, token_cache=None, ledger_path=None,
+                 metrics_json=None, metrics_prom=None, metrics_interval=30, compress_requests=False, http=None,
+                 token_manager=None, profile=False, profile_dump=None):
         self.username = username
         self.password = password
         self.input_filename = input_filename
@@ -52,18 +67,57 @@ class SystemCliBase:
         }
         self.url_suffix = environment_url_suffixes[self.environment]
         self.lookup_only = lookup_only
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.compress_requests = compress_requests
+        # A pool and token manager handed in (e.g. by the job server) are shared with other runs and kept open
+        self.http = http
+        self.owns_http = http is None
+        self.ledger_path = ledger_path
+        self.ledger = None
+        self.metrics = RunMetrics(self.tool_name, json_path=metrics_json, prometheus_path=metrics_prom,
+                                  interval=metrics_interval)
+        self.rate_controller = RateController(max_limit=1, metrics=self.metrics)
+        self.profiler = StageProfiler(profile, profile_dump)
+        self.token_manager = token_manager or TokenManager(
+            self.profiler.wrap('auth', lambda: self.auth_systemservice(self.username, self.password)),
+            cache_path=token_cache, cache_key=f"{environment}:{username}")
         print('Starting...')
 
     def __enter__(self):
+        if self.owns_http:
+            self.http = HttpPool(pool_size=self.pool_size, timeout=self.timeout, retries=self.retries,
+                                 metrics=self.metrics, compress_requests=self.compress_requests,
+                                 profiler=self.profiler)
+        else:
+            # Same connections, but the requests are counted in this run's metrics
+            self.http = self.http.share(metrics=self.metrics, compress_requests=self.compress_requests,
+                                        profiler=self.profiler)
+        self.metrics.start()
+        self.profiler.start()
+        if self.ledger_path:
+            self.ledger = IdempotencyLedger(self.ledger_path, self.environment)
         if self.username and self.password:
-            self.auth_systemservice(self.username, self.password)
+            try:
+                self.token = self.token_manager.get()
+            except Exception:
+                self.metrics.stop(succeeded=False)
+                raise
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        pass
+        self.metrics.stop(succeeded=exc_type is None)
+        self.profiler.stop()
+        if self.http and self.owns_http:
+            self.http.close()
+            self.http = None
+        if self.ledger:
+            self.ledger.close()
+            self.ledger = None
 
     def auth_systemservice(self, username, password):
-        url = f"https://system-service{self.url_suffix}.com/system/rest/v2/login"
+        url = f"{service_url(self.url_suffix)}/system/rest/v2/login"
         data = {
             "user": username,
             "password": password
@@ -73,6 +127,8 @@ class SystemCliBase:
         if response.status_code == 200:
             self.token = response.text
             print('Authenticated Successfully!')
+            # The login endpoint does not return the lifetime; use the JWT 'exp' claim when there is one
+            return self.token, jwt_expiry(self.token)
         else:
             try:
                 detail = response.json().get('detail', 'No detail provided')
@@ -81,13 +137,33 @@ class SystemCliBase:
 
             raise Exception(f"Failed to authenticate. Status code: {response.status_code}, Detail: {detail}")
 
+    def current_token(self):
+        if self.username and self.password:
+            self.token = self.token_manager.get()
+        return self.token
+
+    def renew_token(self, stale_token):
+        """
+        Renew after a 401; concurrent callers holding the same stale token trigger a single login
+        """
+        self.token = self.token_manager.invalidate(stale_token)
+        return self.token
+
     def request_post_json(self, json_data, url):
         headers = {
             "accept": "application/json",
-            "Authorization": self.token,
+            "Authorization": self.current_token(),
             "Content-Type": "application/json"
         }
-        response = requests.post(url, headers=headers, json=json_data)
+        response = self.http.post(url, headers=headers, json=json_data)
+        return response
+
+    def request_get_json(self, url, params=None):
+        headers = {
+            "accept": "application/json",
+            "Authorization": self.current_token()
+        }
+        response = self.http.get(url, headers=headers, params=params)
         return response
 
     def request_post_data(self, json_data, url):
@@ -96,7 +172,7 @@ class SystemCliBase:
             "Authorization": self.token,
             "Content-Type": "application/json"
         }
-        response = requests.post(url, headers=headers, data=json_data)
+        response = self.http.post(url, headers=headers, data=json_data)
         return response
 
     def generate_example_csv(self):
@@ -105,27 +181,65 @@ class SystemCliBase:
     def execute(self):
         pass
 
-    def count_lines(self, filepath):
-        def count_generator(reader):
-            b = reader(1024 * 1024)
-            while b:
-                yield b
-                b = reader(1024 * 1024)
-
-        with open(filepath, 'rb') as fp:
-            c_generator = count_generator(fp.raw.read)
-            count = sum(buffer.count(b'\n') for buffer in c_generator)
-        return count + 1
+    def run_pipeline(self, chunks, transform, send, write, workers=1, backlog=0):
+        """
+        Read chunks, transform them into items, send each item and write the results in input order, with every
+        stage running at the same time (see Pipeline)
+        """
+        Pipeline(chunks, transform).run(send, write, workers, backlog)
 
 
 class ProgressBar:
+    """
+    Result counters plus a progress display redrawn from a background thread every refresh_interval seconds.
+
+    The counter methods only take a lock and add, so they are cheap to call from the hot loop and from several
+    workers. On a terminal the colored bar is redrawn in place; otherwise (cron, CI) a plain line is printed every
+    refresh_interval seconds. Rate and ETA come from the throughput over the last throughput_window seconds.
 
-    def __init__(self, total, length=50):
+    With input_progress (an InputProgress), total is not needed: it follows the row count estimated from the bytes
+    read so far, shown as ~N until the whole input has been read.
+
+    Use it as a context manager so the display thread stops even when the run fails.
+    """
+
+    def __init__(self, total=None, length=50, rate_controller=None, refresh_interval=None, throughput_window=30.0,
+                 stream=None, input_progress=None):
         init(autoreset=True)
+        self.stream = stream or sys.stdout
+        self.interactive = self.stream.isatty()
+        self.refresh_interval = refresh_interval or (0.2 if self.interactive else 10.0)
+        self.throughput_window = throughput_window
         self.start_time = time.time()
         self.total = total
         self.length = length
-        self.totals = [0, 0, 0, total]
+        self.totals = [0, 0, 0, 0, 0, total or 0]
+        self.input_progress = input_progress
+        self.rate_controller = rate_controller
+        self.legend = []
+        self.samples = deque()
+        # Rows counted by resumed(), not processed by this run
+        self.restored = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def run(self):
+        while not self.stopping.wait(self.refresh_interval):
+            self.progress_bar()
+
+    def stop(self):
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
 
     def format_time(self, total_seconds):
         if total_seconds < 60:
@@ -144,42 +258,92 @@ class ProgressBar:
             time_str = f"{days}d {hours}h"
         return time_str
 
-    def progress_bar(self):
-        filled_length = sum(self.totals) - self.totals[-1]
-
-        bars = [
-            Fore.GREEN + '█' * int(self.length * self.totals[0] // self.total),
-            Fore.RED + '█' * int(self.length * self.totals[1] // self.total),
-            Fore.YELLOW + '█' * int(self.length * self.totals[2] // self.total),
-            Fore.LIGHTBLACK_EX + '-' * int(self.length * self.totals[3] // self.total),
-        ]
-
-        bar = ''.join(bars)
-        bar += '-' * (self.length - len(bar))
+    def throughput(self, processed):
+        """
+        Rows per second over the last throughput_window seconds. Rows counted before the first sample (e.g.
+        restored by --resume) are not part of any interval, so they do not inflate the rate
+        """
+        now = time.monotonic()
+        self.samples.append((now, processed))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.throughput_window:
+            self.samples.popleft()
+        first_time, first_processed = self.samples[0]
+        if now - first_time <= 0:
+            # Single sample (e.g. a run shorter than one refresh): average since the start, without restored rows
+            elapsed = time.time() - self.start_time
+            return (processed - self.restored) / elapsed if elapsed > 0 else 0.0
+        return (processed - first_processed) / (now - first_time)
+
+    def refresh_total(self):
+        estimate = self.input_progress.estimated_rows()
+        if estimate is None:
+            return
+        with self.lock:
+            self.totals[-1] += estimate - (self.total or 0)
+            self.total = estimate
 
-        elapsed_time = time.time() - self.start_time
-        estimated_time_left = elapsed_time / (filled_length if filled_length != 0 else 1) * self.totals[-1]
-        time_left_str = self.format_time(estimated_time_left)
+    def progress_bar(self):
+        if self.input_progress:
+            self.refresh_total()
+        with self.lock:
+            totals = list(self.totals)
+        processed = sum(totals) - totals[-1]
+        throughput = self.throughput(processed)
+        known = self.total is not None
+        time_left_str = self.format_time(totals[-1] / throughput) if throughput > 0 and known else '--'
+        total = max(self.total or 0, processed) or 1
+        if not known:
+            total_str = '?'
+        elif self.input_progress and not self.input_progress.finished:
+            total_str = f'~{self.total}'
+        else:
+            total_str = str(self.total)
 
         self.legend = [
-            Fore.GREEN + f'Entities Processed: {self.totals[0]}',
-            Fore.RED + f'Validation Error: {self.totals[1]}',
-            Fore.YELLOW + f'Suggestions Found: {self.totals[2]}',
-            Fore.LIGHTBLACK_EX + f'Remaining: {self.totals[3]}',
+            Fore.GREEN + f'Entities Processed: {totals[0]}',
+            Fore.RED + f'Validation Error: {totals[1]}',
+            Fore.YELLOW + f'Suggestions Found: {totals[2]}',
+            Fore.BLUE + f'Duplicates Skipped: {totals[3]}',
+            Fore.LIGHTBLACK_EX + f'Remaining: {totals[5] if known else "?"}',
             Fore.WHITE + f'Time Left: {time_left_str}',
         ]
+        if totals[4]:
+            # Only --lookup-only runs have rows without a match
+            self.legend.insert(4, Fore.MAGENTA + f'Not Found: {totals[4]}')
+        rate = f'Rate: {throughput:.1f}/s'
+        if self.rate_controller:
+            rate += f' (limit {self.rate_controller.current_limit()})'
+        self.legend.append(Fore.CYAN + rate)
+
+        if self.interactive:
+            bars = [
+                Fore.GREEN + '█' * int(self.length * totals[0] // total),
+                Fore.RED + '█' * int(self.length * totals[1] // total),
+                Fore.YELLOW + '█' * int(self.length * totals[2] // total),
+                Fore.BLUE + '█' * int(self.length * totals[3] // total),
+                Fore.MAGENTA + '█' * int(self.length * totals[4] // total),
+                Fore.LIGHTBLACK_EX + '-' * int(self.length * totals[5] // total),
+            ]
+            bar = ''.join(bars)
+            bar += '-' * (self.length - len(bar))
+            self.stream.write('\r|{}| {} {}\r'.format(bar, ' '.join(self.legend), ' ' * 10))
+        else:
+            self.stream.write(f"{time.strftime('%H:%M:%S')} {processed}/{total_str} ({processed * 100 / total:.1f}%) "
+                              f"created={totals[0]} errors={totals[1]} suggestions={totals[2]} skipped={totals[3]} "
+                              f"not_found={totals[4]} remaining={totals[5] if known else '?'} {rate} "
+                              f"eta={time_left_str}\n")
+        self.stream.flush()
 
-        sys.stdout.write('\r|{}| {} {}\r'.format(bar, ' '.join(self.legend), ' ' * 10))
-        sys.stdout.flush()
-
-        return self.legend[:-2]  # Retiramos Remaining e Time Left
+        return self.legend[:4]  # Retiramos Remaining, Time Left e Rate
 
     def print_final_stats(self):
+        self.stop()
+        self.progress_bar()
         elapsed_time = time.time() - self.start_time
-        sys.stdout.write("\n\n")
+        self.stream.write("\n\n")
         for stat in self.legend:
-            sys.stdout.write(stat + "\n")
-        sys.stdout.write(Fore.WHITE + "Total time elapsed: {}\n\n".format(self.format_time(elapsed_time)))
+            self.stream.write(stat + "\n")
+        self.stream.write(Fore.WHITE + "Total time elapsed: {}\n\n".format(self.format_time(elapsed_time)))
 
     def id_created(self):
         _totals = [1, 0, 0]
@@ -193,8 +357,35 @@ class ProgressBar:
         _totals = [0, 0, 1]
         self.update_totals(_totals)
 
+    def duplicate_skipped(self):
+        _totals = [0, 0, 0, 1]
+        self.update_totals(_totals)
+
+    def not_found(self):
+        _totals = [0, 0, 0, 0, 1]
+        self.update_totals(_totals)
+
+    def resumed(self, created):
+        """
+        Count the rows already created by an earlier run (--resume)
+        """
+        self.restored += created
+        self.update_totals([created, 0, 0])
+
+    def update_status(self, status):
+        if status == 'created':
+            self.id_created()
+        elif status == 'skipped_duplicate':
+            self.duplicate_skipped()
+        elif status == 'not_found':
+            self.not_found()
+        elif status in ('found', 'multiple_matches'):
+            self.suggestion_found()
+        else:
+            self.validation_error()
+
     def update_totals(self, updates):
-        for i, update in enumerate(updates):
-            self.totals[i] += update
-        self.totals[-1] -= sum(updates)
-        self.legend = self.progress_bar()
+        with self.lock:
+            for i, update in enumerate(updates):
+                self.totals[i] += update
+            self.totals[-1] -= sum(updates)
@@ -1,32 +1,86 @@
 #!/usr/bin/env python3
-import pandas as pd
 import argparse
+import multiprocessing
+import queue
 import sys
-
+from collections import deque
+
+from checkpoint import CheckpointJournal, RestoredRows
+from clientlookup import LOOKUP_PATH, ClientLookup, TooManyMatches
+from columnplan import ColumnPlan
+from compressedio import compression
+from endpoints import gateway_url
+from inputreader import InputProgress, count_range_rows, open_range, read_chunks, read_header, shard_ranges
+from ratecontroller import RateController
+from resultwriter import ResultRow, ResultWriter, open_sink, output_format
+from retryqueue import RetryQueue, TransientError, is_transient, is_transient_exception
+from rowvalidation import RowValidator, validate_rows
 from systemclibase import SystemCliBase, ProgressBar
 
+# Payload path -> CSV column
+CLIENT_FIELDS = {
+    'client.firstname': 'client_firstname',
+    'client.lastname': 'client_surname',
+    'client.fantasyName': 'client_fantasy_name',
+}
+
+# Payload path -> CSV column prefix of the '<prefix>[i].code' / '<prefix>[i].value' slots
+CLIENT_IDENTIFIERS = {
+    'client.identifiers': 'client_identifiers',
+}
+
+# Columns the file must have and every row must fill
+REQUIRED_COLUMNS = [
+    'client_fantasy_name', 'client_surname', 'client_firstname'
+]
+
+# Identifier slots whose code and value must be filled together
+IDENTIFIER_PAIRS = [
+    (f"{prefix}[{i}].code", f"{prefix}[{i}].value") for prefix in CLIENT_IDENTIFIERS.values() for i in range(3)
+]
+
+VALIDATION_CHUNK_SIZE = 10000
+
 
 class SystemcliCreate(SystemCliBase):
-    def __init__(self, **kwargs):
+    tool_name = 'create'
+
+    def __init__(self, workers=1, resume=False, processes=1, validate_only=False, retry_attempts=5,
+                 lookup_before_create=False, **kwargs):
         super().__init__(**kwargs)
+        self.options = dict(kwargs, workers=workers, retry_attempts=retry_attempts,
+                            lookup_before_create=lookup_before_create)
         self.actual_columns = set()
-
-    def validate_csv_columns(self, df):
+        self.output_columns = None
+        self.column_plan = None
+        self.validator = None
+        self.validate_only = validate_only
+        self.workers = workers
+        self.resume = resume
+        self.processes = processes
+        self.pool_size = max(self.pool_size, workers)
+        self.rate_controller = RateController(max_limit=workers, metrics=self.metrics)
+        self.retry_queue = RetryQueue(max_attempts=retry_attempts, workers=workers, metrics=self.metrics)
+        self.lookup_before_create = lookup_before_create
+        self.client_lookup = ClientLookup(self.lookup_call)
+        # In a shard: ledger entries of the clients created, handed to the parent, which alone writes the ledger
+        self.ledger_outbox = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.retry_queue.close()
+        super().__exit__(exc_type, exc_value, traceback)
+
+    def validate_csv_columns(self, columns):
         """
         Validate that all required columns exist in the CSV
         """
-        self.actual_columns = set(df.columns)
-
-        # Define required columns
-        required_columns = [
-            'client_fantasy_name', 'client_surname', 'client_firstname'
-        ]
+        self.actual_columns = set(columns)
 
         print("Column validation:")
         print("-" * 40)
 
         missing_columns = []
-        for col in required_columns:
+        for col in REQUIRED_COLUMNS:
             if col in self.actual_columns:
                 print(f"✓ {col}")
             else:
@@ -44,123 +98,398 @@ class SystemcliCreate(SystemCliBase):
         print("\nColumn validation passed!")
         return True
 
-    def safe_get_value(self, row, column_name):
-        """
-        Safely get value from row, handling missing columns gracefully
-        """
-        if column_name in self.actual_columns:
-            return self.get_value(row[column_name])
-        else:
-            return None
-
     def generate_example_csv(self):
-        csv = """client_name;client_fantasy_name;client_surname"""
+        csv = ("client_firstname;client_surname;client_fantasy_name;"
+               "client_identifiers[0].code;client_identifiers[0].value\n")
 
         with open(self.output_filename, 'w') as f:
             f.write(csv)
         print(f"Example CSV file generated: {self.output_filename}")
 
     def execute(self):
-        lines = self.count_lines(self.input_filename)
-        print(f"{lines -1} to be processed...\n")
+        if self.validate_only:
+            return self.execute_validate_only()
+        if self.processes > 1 and compression(self.input_filename):
+            print("A compressed input can not be split into parts; using a single process.\n")
+        elif self.processes > 1:
+            self.execute_sharded()
+            return
+
+        # No pre-scan: the row count is estimated from the bytes read while the file is processed
+        input_progress = InputProgress(self.input_filename)
+        print(f"Processing {self.input_filename} ({input_progress.size / 1024 / 1024:.1f} MB)...\n")
+
+        self.prepare_columns()
+        journal = CheckpointJournal(f"{self.output_filename}.journal")
+        with ProgressBar(length=35, rate_controller=self.rate_controller, input_progress=input_progress) \
+                as progress_bar, self.open_writer(self.output_filename) as writer:
+            restored = RestoredRows()
+            if self.resume:
+                restored = RestoredRows.from_journal(journal, self.column_plan.columns)
+                print(f"Resuming: {len(restored)} rows already created.\n")
+                progress_bar.resumed(len(restored))
+
+            with journal.open(resume=self.resume):
+                chunks = read_chunks(self.input_filename, chunksize=100, progress=input_progress)
+                self.process_rows(self.profiler.iterate('read', chunks), restored, journal,
+                                  progress_bar.update_status, writer)
+            writer.write(restored.take())
 
-        sample_df = pd.read_csv(self.input_filename, sep=';', header=0, index_col=False, nrows=1)
-        print(f"Validating CSV structure...\n")
-        self.validate_csv_columns(sample_df)
-
-        progress_bar = ProgressBar(lines-1, length=35)
+        progress_bar.print_final_stats()
 
-        first_iteration = True
-        for chunk in pd.read_csv(self.input_filename, sep=';', header=0, index_col=False, chunksize=100):
-            csv_rows = []
+    def open_writer(self, filename, header=True):
+        """
+        Background writer in the format of output_filename (CSV, JSONL or Parquet), also for the shard parts
+        """
+        sink = open_sink(filename, self.output_columns, output_format(self.output_filename), sep=';', header=header)
+        return ResultWriter(sink, self.column_plan.columns, profiler=self.profiler)
+
+    def prepare_columns(self, validate=True):
+        columns = read_header(self.input_filename)
+        if validate:
+            print(f"Validating CSV structure...\n")
+            self.validate_csv_columns(columns)
+        self.output_columns = columns + ['result_status', 'id', 'input_file_line', 'error_message']
+        self.column_plan = ColumnPlan(columns, CLIENT_FIELDS, CLIENT_IDENTIFIERS)
+        self.validator = RowValidator(columns, REQUIRED_COLUMNS, IDENTIFIER_PAIRS)
+
+    def plan_rows(self, chunks, done_lines, first_index=0):
+        """
+        Yield (index, values, validation error or None, payload) for the rows not created yet, validating chunk by
+        chunk; invalid rows get no payload
+        """
+        for chunk in chunks:
+            with self.profiler.stage('validate'):
+                errors = self.validator.errors(chunk)
+            for position, (index, row) in enumerate(self.column_plan.rows(chunk)):
+                if first_index + index + 2 not in done_lines:
+                    error = errors.get(position)
+                    payload = None
+                    if not error:
+                        with self.profiler.stage('payload'):
+                            payload = self.populate_create_json(row)
+                    yield first_index + index, row, error, payload
+
+    def execute_validate_only(self):
+        """
+        Check every row without calling SYSTEM; the invalid rows are written to the output file.
+        Returns the number of invalid rows
+        """
+        self.prepare_columns()
+        chunks = read_chunks(self.input_filename, chunksize=VALIDATION_CHUNK_SIZE)
+        return validate_rows(chunks, self.validator, self.open_writer(self.output_filename), self.output_filename,
+                             self.profiler)
 
-            for index, row in chunk.iterrows():
+    def process_rows(self, chunks, restored, journal, on_status, writer, first_index=0):
+        """
+        Create the clients for the rows of chunks not restored, journaling the results and handing them to the writer
+        in input order, merged with the restored rows that precede them. Reading, planning, sending and writing
+        overlap (see run_pipeline)
+        """
+        def write(result):
+            status, row_results = result
+            with self.profiler.stage('journal'):
+                for csv_row in row_results:
+                    journal.record(csv_row.to_dict(self.column_plan.columns))
+            writer.write(restored.merge(row_results))
+            self.metrics.row(status)
+            on_status(status)
+
+        backlog = self.retry_queue.backlog if self.retry_queue.max_attempts else 0
+        self.run_pipeline(chunks, lambda chunks: self.plan_rows(chunks, restored.lines, first_index), self.process_row,
+                          write, self.workers, backlog)
+
+    def execute_sharded(self):
+        """
+        Split the input into line-aligned byte ranges and process each one in its own process
+        """
+        shards = shard_ranges(self.input_filename, self.processes)
+        shard_rows = [count_range_rows(self.input_filename, start, end) for start, end in shards]
+        print(f"{sum(shard_rows)} to be processed in {len(shards)} shards...\n")
+
+        self.prepare_columns()
+        # The shards run their own rate controllers; this process' one is never used
+        with ProgressBar(sum(shard_rows), length=35) as progress_bar:
+            journal = CheckpointJournal(f"{self.output_filename}.journal")
+            writer = self.open_writer(self.output_filename)
+            restored = RestoredRows()
+            if self.resume:
+                restored = RestoredRows.from_journal(journal, self.column_plan.columns)
+                print(f"Resuming: {len(restored)} rows already created.\n")
+                progress_bar.resumed(len(restored))
+            # Create or truncate the journal here; the shard processes only append to it
+            journal.open(resume=self.resume).close()
+
+            # Shards reuse this process' token instead of logging in once each
+            options = dict(self.options, token=self.token_manager.token, token_expires_at=self.token_manager.expires_at)
+            context = multiprocessing.get_context('spawn')
+            status_queue = context.Queue()
+            processes = []
+            first_index = 0
+            for number, ((start, end), rows) in enumerate(zip(shards, shard_rows)):
+                shard = {
+                    'number': number,
+                    'start': start,
+                    'end': end,
+                    'first_index': first_index,
+                    # Merged into the shard's part, so the output stays in input order
+                    'restored': restored.take(first_index + rows + 2)
+                }
+                process = context.Process(target=run_shard, args=(options, shard, status_queue))
+                process.start()
+                processes.append(process)
+                first_index += rows
+
+            with writer:
+                self.drain_shard_statuses(processes, status_queue, progress_bar)
+                for number in range(len(shards)):
+                    writer.append_file(f"{self.output_filename}.part{number}")
+                # Journaled lines past the end of the input
+                writer.write(restored.take())
+
+            failed = [number for number, process in enumerate(processes) if process.exitcode != 0]
+            if failed:
+                raise Exception(f"Shards {failed} did not finish. Run again with --resume to process their rows.")
+            progress_bar.print_final_stats()
+
+    def drain_shard_statuses(self, processes, status_queue, progress_bar):
+        while True:
+            try:
+                message = status_queue.get(timeout=0.5)
+            except queue.Empty:
+                if any(process.is_alive() for process in processes):
+                    continue
+                # Everything a finished process put is already in the pipe
                 try:
-                
-                    if self.create_client(csv_rows, row, index):
-                        progress_bar.id_created()
-                    else:
-                        progress_bar.validation_error()
-
-                except Exception as e:
-                    print(f"Error processing row {index}: {e}")
-                    csv_row = row.to_dict()
-                    csv_row['result_status'] = 'error'
-                    csv_row['error_message'] = str(e)
-                    csv_rows.append(csv_row)
-                    progress_bar.validation_error()
-
-            df = pd.DataFrame(csv_rows)
-            if first_iteration:
-                first_iteration = False
-                df.to_csv(self.output_filename, mode='w', sep=';', index=False)
-            else:
-                df.to_csv(self.output_filename, mode='a', sep=';', header=False, index=False)
-
-        progress_bar.print_final_stats()
-
-    def get_identifiers_safe(self, row, prefix):
+                    message = status_queue.get(timeout=0.1)
+                except queue.Empty:
+                    break
+            for status in message['statuses']:
+                self.metrics.row(status)
+                progress_bar.update_status(status)
+            for ledger_key, client_id in message['ledger']:
+                self.record_in_ledger(ledger_key, client_id)
+            self.metrics.merge_requests(message['shard'], message['metrics'])
+            if 'stages' in message:
+                # Final profile stages of a shard
+                self.profiler.merge(message['stages'])
+        for process in processes:
+            process.join()
+
+    def execute_shard(self, shard, status_queue):
+        """
+        Worker side of execute_sharded: process one byte range and report row statuses and ledger entries in
+        batches, each with the shard's request metrics so far
+        """
+        import pandas as pd
+
+        self.prepare_columns(validate=False)
+        part_filename = f"{self.output_filename}.part{shard['number']}"
+        # The ledger is only read here: a single writer keeps the shards from locking each other out of it
+        self.ledger_outbox = deque()
+
+        statuses = []
+
+        def report(final=False):
+            ledger_entries = []
+            while self.ledger_outbox:
+                ledger_entries.append(self.ledger_outbox.popleft())
+            message = {'shard': shard['number'], 'statuses': list(statuses), 'ledger': ledger_entries,
+                       'metrics': self.metrics.snapshot()}
+            statuses.clear()
+            if final:
+                message['stages'] = self.profiler.totals()
+            status_queue.put(message)
+
+        def on_status(status):
+            statuses.append(status)
+            if len(statuses) >= 100:
+                report()
+
+        first_index = shard['first_index']
+        restored = RestoredRows(shard['restored'])
+        journal = CheckpointJournal(f"{self.output_filename}.journal")
+        with open_range(self.input_filename, shard['start'], shard['end']) as f, journal.open(resume=True), \
+                self.open_writer(part_filename, header=False) as writer:
+            chunks = pd.read_csv(f, sep=';', header=None, names=self.column_plan.columns, index_col=False,
+                                 chunksize=100, dtype=str)
+            self.process_rows(self.profiler.iterate('read', chunks), restored, journal, on_status, writer,
+                              first_index)
+            writer.write(restored.take())
+
+        report(final=True)
+
+    def process_row(self, item, attempt=0):
         """
-        Safely extract identifiers, handling missing columns
+        Create (or in lookup_only mode look up) the client for a single plan_rows item, returning the result status
+        and its output rows, or a Future of them when a transient failure deferred the row to the retry queue
         """
-        identifiers = []
-        for i in range(3):  # Check up to 3 identifiers
-            code_col = f"{prefix}[{i}].code"
-            value_col = f"{prefix}[{i}].value"
+        index, row, validation_error, json_data = item
+        csv_rows = []
+        if validation_error:
+            # Rejected locally: no request is sent
+            return 'validation_error', [ResultRow(row, index+2, 'validation_error', error_message=validation_error)]
+        try:
+            if self.lookup_only:
+                self.lookup_client(csv_rows, row, index, json_data)
+            else:
+                self.create_client(csv_rows, row, index, json_data)
+        except TransientError as e:
+            if self.retry_queue.can_retry(attempt):
+                return self.retry_queue.defer(lambda: self.process_row(item, attempt + 1), attempt)
+            csv_rows.append(ResultRow(row, index+2, 'error',
+                                      error_message=f"{e} (gave up after {attempt + 1} attempts)"))
+        except Exception as e:
+            print(f"Error processing row {index}: {e}")
+            csv_rows.append(ResultRow(row, index+2, 'error', error_message=str(e)))
+        return csv_rows[-1].result_status, csv_rows
 
-            code = self.safe_get_value(row, code_col)
-            value = self.safe_get_value(row, value_col)
+    def populate_create_json(self, row):
+        return self.column_plan.build(row)
 
-            if code and value:
-                identifiers.append({"code": code, "value": value})
+    def create_client(self, csv_rows, row, index, json_data):
+        ledger_key = None
+        try:
+            ledger_key = self.ledger.key('create_client', json_data) if self.ledger else None
+            if ledger_key:
+                applied, client_id = self.ledger.lookup(ledger_key)
+                if applied:
+                    csv_rows.append(ResultRow(row, index+2, 'skipped_duplicate', id=client_id))
+                    return False
+
+            lookup_key = self.client_lookup.key(json_data) if self.lookup_before_create else None
+            if lookup_key:
+                created = []
+                ids, _ = self.client_lookup.cache.load(
+                    lookup_key, lambda: self.find_or_create(lookup_key, json_data, created))
+                csv_rows.append(ResultRow(row, index+2, 'created' if created else 'skipped_duplicate',
+                                          id=','.join(ids)))
+                created = bool(created)
+            else:
+                response = self.create_call(json_data)
+                if is_transient(response):
+                    raise TransientError(f"Status code: {response.status_code}")
+                if response.status_code not in [200, 201]:
+                    error_detail = response.json().get('detail', response.text) if response.text else 'Unknown error'
+                    csv_rows.append(ResultRow(row, index+2, 'error', error_message=error_detail))
+                    return False
+                csv_rows.append(ResultRow(row, index+2, 'created', id=response.json().get('id')))
+                created = True
+        except TransientError:
+            raise
+        except Exception as e:
+            csv_rows.append(ResultRow(row, index+2, 'error', error_message=str(e)))
+            return False
 
-        return identifiers
+        # Outside the request's try: the client exists whatever happens to the ledger write
+        if created and ledger_key:
+            csv_rows[-1].error_message = self.record_in_ledger(ledger_key, csv_rows[-1].id)
+        return created
 
-    def populate_create_json(self, row):
+    def record_in_ledger(self, ledger_key, client_id):
+        """
+        Record a created client in the ledger (in a shard, hand it to the parent). Returns the error message when
+        the write failed
+        """
+        if self.ledger_outbox is not None:
+            self.ledger_outbox.append((ledger_key, client_id))
+            return None
+        try:
+            self.ledger.record(ledger_key, 'create_client', client_id)
+        except Exception as e:
+            print(f"\nCould not record client {client_id} in the ledger: {e}")
+            return f"Created, but not recorded in the ledger: {e}"
+        return None
 
-        json_data = {
-            "client": {
-                "firstname": first,
-                "lastname": last
-            }
-        }
-        return json_data
+    def find_or_create(self, key, json_data, created):
+        """
+        Ids of the existing clients matching key, or of the client created from json_data when there is none
+        (appended to created as well)
+        """
+        try:
+            ids = self.client_lookup.fetch(key)
+        except TooManyMatches as e:
+            # Enough to know the client exists
+            return e.ids
+        if ids:
+            return ids
+        response = self.create_call(json_data)
+        if is_transient(response):
+            raise TransientError(f"Status code: {response.status_code}")
+        if response.status_code not in [200, 201]:
+            raise Exception(response.json().get('detail', response.text) if response.text else 'Unknown error')
+        client_id = str(response.json().get('id'))
+        created.append(client_id)
+        return [client_id]
+
+    def lookup_client(self, csv_rows, row, index, json_data):
+        try:
+            key = self.client_lookup.key(json_data)
+            if key is None:
+                raise Exception("No identifier or name to look up")
+            ids = self.client_lookup.find(key)
+        except TransientError:
+            raise
+        except Exception as e:
+            csv_rows.append(ResultRow(row, index+2, 'error', error_message=str(e)))
+            return
+        if not ids:
+            csv_rows.append(ResultRow(row, index+2, 'not_found'))
+        elif len(ids) == 1:
+            csv_rows.append(ResultRow(row, index+2, 'found', id=ids[0]))
+        else:
+            csv_rows.append(ResultRow(row, index+2, 'multiple_matches', id=','.join(ids)))
 
-    def create_client(self, csv_rows, row, index):
+    def lookup_call(self, params, intent=0):
+        url = f"{gateway_url(self.url_suffix)}{LOOKUP_PATH}"
         try:
-            response = self.create_call(self.populate_create_json(row))
-            if response.status_code in [200, 201]:
-                csv_row = row.to_dict()
-                csv_row['result_status'] = 'created'
-                csv_row['id'] = response.json().get('id')
-                csv_row['input_file_line'] = index+2
-                csv_rows.append(csv_row)
-                return True
-            else:
-                csv_row = row.to_dict()
-                csv_row['result_status'] = 'error'
-                csv_row['input_file_line'] = index+2
-                error_detail = response.json().get('detail', response.text) if response.text else 'Unknown error'
-                csv_row['error_message'] = error_detail
-                csv_rows.append(csv_row)
-                return False
+            response = self.rate_controller.call(lambda: self.request_get_json(url, params))
         except Exception as e:
-            csv_row = row.to_dict()
-            csv_row['result_status'] = 'error'
-            csv_row['input_file_line'] = index+2
-            csv_row['error_message'] = str(e)
-            csv_rows.append(csv_row)
-            return False
+            if is_transient_exception(e):
+                raise TransientError(str(e))
+            raise
+
+        if response.status_code == 401 and intent == 0:
+            self.metrics.retry('unauthorized')
+            self.renew_token(response.request.headers.get('Authorization'))
+            return self.lookup_call(params, intent+1)
+        if is_transient(response):
+            raise TransientError(f"Status code: {response.status_code}")
+
+        return response
 
     def create_call(self, json_data, intent=0):
-        response = self.request_post_json(json_data, f"https://system-gateway{self.url_suffix}.com/system-client/clients")
+        url = f"{gateway_url(self.url_suffix)}/system-client/clients"
+        try:
+            response = self.rate_controller.call(lambda: self.request_post_json(json_data, url))
+        except Exception as e:
+            if is_transient_exception(e):
+                raise TransientError(str(e))
+            raise
 
         if response.status_code == 401 and intent == 0:
-            self.auth_systemservice(self.username, self.password)
+            self.metrics.retry('unauthorized')
+            self.renew_token(response.request.headers.get('Authorization'))
             return self.create_call(json_data, intent+1)
 
         return response
 
+def run_shard(options, shard, status_queue):
+    options = dict(options)
+    token = options.pop('token')
+    token_expires_at = options.pop('token_expires_at')
+    # Only the parent exports metrics and prints the profile (the cProfile dump covers the parent only); the shard
+    # sends its request counters and stage times back through the status queue
+    profile_dump = options.pop('profile_dump', None)
+    profile = options.pop('profile', False) or bool(profile_dump)
+    options.update(metrics_json=None, metrics_prom=None)
+    app = SystemcliCreate(profile=profile, **options)
+    app.profiler.quiet = True
+    app.token_manager.set_token(token, token_expires_at)
+    with app:
+        app.execute_shard(shard, status_queue)
+
+
 def main():
     epilog = (
         "    \n"
@@ -180,20 +509,88 @@ def main():
         "           Generate an example CSV file. \n"
         "           This option can be used only with -o.\n\n"
         "       -i input_filename\n"
-        "           Input file for the operation.\n\n"
+        "           Input file for the operation. A file ending with .gz or .zst is decompressed while it is read\n"
+        "           (.zst needs the zstandard package).\n\n"
         "       -o output_filename\n"
-        "           Output file to be generated (will be overwritten if it already exists).\n\n"
+        "           Output file to be generated (will be overwritten if it already exists).\n"
+        "           Written as ';' separated CSV, or as JSON lines / Parquet when the name ends with .jsonl or\n"
+        "           .parquet (Parquet needs the pyarrow package). A further .gz or .zst extension compresses the\n"
+        "           file while it is written, e.g. result.csv.gz.\n\n"
         "       -u username\n"
         "           Username to connect to the SYSTEM API.\n\n"
         "       -p password\n"
         "           Password to connect to the SYSTEM API.\n\n"
         "       -env environment\n"
         "           Specify the environment to be used; options include 'prod', 'test' (default), 'qa',  and 'dev'.\n\n"
+        "       --workers N\n"
+        "           Maximum number of clients created concurrently (default 1). Results keep the input order.\n"
+        "           The tool starts below this limit, backs off when the gateway answers 429/503 or slows down\n"
+        "           and ramps back up when it recovers.\n\n"
+        "       --processes N\n"
+        "           Split the input file into N line-aligned parts processed by N processes (default 1), each one\n"
+        "           using --workers concurrent requests. The results are merged into output_filename in input\n"
+        "           order.\n\n"
+        "       --resume\n"
+        "           Resume an interrupted run: rows journaled as created in output_filename.journal are\n"
+        "           kept and skipped, all other rows are processed again.\n\n"
+        "       --ledger path\n"
+        "           SQLite file recording every client created. Rows whose payload is already in the ledger are\n"
+        "           not sent again and are reported as skipped_duplicate. With --processes, only the main process\n"
+        "           writes the ledger, from the results of the others.\n\n"
+        "       --lookup-only\n"
+        "           Do not create anything: look each row up among the existing clients, by its first identifier\n"
+        "           or else by its names, and report it as found (with its id), multiple_matches (ids separated by\n"
+        "           ',') or not_found. Repeated identifiers / names in the file are looked up once. A search\n"
+        "           matching more than 1000 clients is reported as an error rather than a partial list.\n\n"
+        "       --lookup-before-create\n"
+        "           Look each row up the same way before creating it: rows matching an existing client, or one\n"
+        "           created earlier in the run, are reported as skipped_duplicate with its id instead of creating\n"
+        "           a duplicate. Costs one lookup per distinct identifier / name.\n\n"
+        "       --token-cache path\n"
+        "           Keep the access token in this file (readable only by you) so that runs started before it\n"
+        "           expires skip the login.\n\n"
+        "       --timeout seconds\n"
+        "           Timeout for each HTTP request (default 60).\n\n"
+        "       --retries N\n"
+        "           Number of retries on connection errors (default 3).\n\n"
+        "       --retry-attempts N\n"
+        "           Rows failing with a transient error (connection reset, timeout, 429, 502, 503, 504) are set aside\n"
+        "           and sent again up to N times (default 5) with a growing random delay, while the other rows go on.\n"
+        "           Only rows still failing after that are reported as error. Use 0 to disable. Note that a request\n"
+        "           that timed out or got a 504 may already have been applied by SYSTEM.\n\n"
+        "       --gzip-requests\n"
+        "           Send request bodies of 256 bytes or more gzip compressed (Content-Encoding: gzip). Only use it\n"
+        "           when the gateway accepts compressed requests.\n\n"
+        "       --metrics-json path\n"
+        "           Write run metrics (request latency histograms per endpoint, status codes, bytes sent, retries\n"
+        "           and rows per result status) to this JSON file during and at the end of the run.\n\n"
+        "       --metrics-prom path\n"
+        "           Write the same metrics in Prometheus text format, e.g. for the node_exporter textfile\n"
+        "           collector.\n\n"
+        "       --metrics-interval seconds\n"
+        "           How often the metrics files are rewritten while the run is in progress (default 30).\n\n"
+        "       --profile\n"
+        "           At the end of the run, print the wall and CPU time spent per stage: read (parsing the input),\n"
+        "           validate, payload (building the request bodies), encode (JSON / gzip), http (waiting for\n"
+        "           SYSTEM), auth (logins), journal and write (the output file). With --processes, the stages of\n"
+        "           all processes are added up.\n\n"
+        "       --profile-dump path\n"
+        "           Same as --profile, and also write cProfile statistics of every thread to this file, to be read\n"
+        "           with python -m pstats. With --processes, only the main process is covered.\n\n"
+        "       --validate-only\n"
+        "           Only check the rows (required names filled, identifier code and value filled together) without\n"
+        "           connecting to SYSTEM; -u and -p are not needed. The invalid rows are written to output_filename\n"
+        "           and the exit status is 1 when there is any. In normal runs invalid rows are reported as\n"
+        "           validation_error without being sent.\n\n"
         "USAGE EXAMPLE\n"
         "       Generating an example CSV file\n"
         "       ./systemclicreate.py -e -o template.csv\n\n"
         "       Creating  in Test environment\n"
-        "       ./systemclicreate.py -i input_file.csv -o result.csv -u USER -p PASS -env test\n"
+        "       ./systemclicreate.py -i input_file.csv -o result.csv -u USER -p PASS -env test\n\n"
+        "       Creating  in Test environment with 16 concurrent requests\n"
+        "       ./systemclicreate.py -i input_file.csv -o result.csv -u USER -p PASS -env test --workers 16\n\n"
+        "       Checking a file before sending it\n"
+        "       ./systemclicreate.py -i input_file.csv -o invalid_rows.csv --validate-only\n"
         "    \n"
     )
 
@@ -211,6 +608,24 @@ def main():
     parser.add_argument("-p", dest="password", help=argparse.SUPPRESS)
     parser.add_argument("-env", dest="environment", default='test', choices=['prod', 'test', 'qa', 'dev'],
                         help=argparse.SUPPRESS)
+    parser.add_argument("--workers", dest="workers", type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument("--processes", dest="processes", type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument("--resume", dest="resume", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--ledger", dest="ledger_path", help=argparse.SUPPRESS)
+    parser.add_argument("--lookup-only", dest="lookup_only", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--lookup-before-create", dest="lookup_before_create", action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--token-cache", dest="token_cache", help=argparse.SUPPRESS)
+    parser.add_argument("--timeout", dest="timeout", type=float, default=60, help=argparse.SUPPRESS)
+    parser.add_argument("--retries", dest="retries", type=int, default=3, help=argparse.SUPPRESS)
+    parser.add_argument("--retry-attempts", dest="retry_attempts", type=int, default=5, help=argparse.SUPPRESS)
+    parser.add_argument("--validate-only", dest="validate_only", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--gzip-requests", dest="compress_requests", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-json", dest="metrics_json", help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-prom", dest="metrics_prom", help=argparse.SUPPRESS)
+    parser.add_argument("--metrics-interval", dest="metrics_interval", type=float, default=30, help=argparse.SUPPRESS)
+    parser.add_argument("--profile", dest="profile", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument("--profile-dump", dest="profile_dump", help=argparse.SUPPRESS)
 
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
@@ -223,11 +638,26 @@ def main():
             parser.error("-e must be used only with -o")
         with SystemcliCreate(output_filename=args.output_filename) as app:
             app.generate_example_csv()
+    elif args.validate_only:
+        if not all([args.input_filename, args.output_filename]):
+            parser.error("-i and -o must be specified with --validate-only")
+        with SystemcliCreate(input_filename=args.input_filename, output_filename=args.output_filename,
+                             validate_only=True, profile=args.profile, profile_dump=args.profile_dump) as app:
+            invalid = app.execute()
+        if invalid:
+            sys.exit(1)
     else:
         if not all([args.input_filename, args.output_filename, args.username, args.password]):
             parser.error("-u, -p, -i, and -o must be specified. (-env is optional)")
         with SystemcliCreate(username=args.username, password=args.password, input_filename=args.input_filename,
-                            output_filename=args.output_filename, environment=args.environment) as app:
+                            output_filename=args.output_filename, environment=args.environment,
+                            workers=args.workers, processes=args.processes, resume=args.resume, timeout=args.timeout,
+                            retries=args.retries, retry_attempts=args.retry_attempts, token_cache=args.token_cache,
+                            ledger_path=args.ledger_path, lookup_only=args.lookup_only,
+                            lookup_before_create=args.lookup_before_create, metrics_json=args.metrics_json,
+                            metrics_prom=args.metrics_prom, metrics_interval=args.metrics_interval,
+                            compress_requests=args.compress_requests, profile=args.profile,
+                            profile_dump=args.profile_dump) as app:
             app.execute()
 
 
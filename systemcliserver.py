@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import json
+import os
+import signal
+import socketserver
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from systemcliaddidentifier import SystemCliAddIdentifier
+from systemclicreate import SystemcliCreate
+
+ENVIRONMENTS = ('prod', 'test', 'qa', 'dev')
+
+# Operation -> job options it accepts, with their types
+JOB_OPTIONS = {
+    'create': {'workers': int, 'resume': bool, 'retry_attempts': int, 'lookup_before_create': bool,
+               'ledger_path': str, 'compress_requests': bool},
+    'lookup': {'workers': int, 'retry_attempts': int},
+    'addidentifier': {'max_in_flight': int, 'resume': bool, 'retry_attempts': int, 'ledger_path': str,
+                      'compress_requests': bool},
+}
+
+# Finished jobs kept for status queries
+MAX_FINISHED_JOBS = 1000
+
+SPOOL_POLL_INTERVAL = 1.0
+
+
+def job_option(name, kind, value):
+    # bool('false') is True: a flag must come as a JSON boolean
+    if kind is bool and not isinstance(value, bool):
+        raise ValueError(f"{name} must be true or false")
+    return kind(value)
+
+
+class JobServer:
+    """
+    Runs create / lookup / addidentifier jobs on a pool of threads, so the imports, the logins and the open
+    connections of one job are reused by the next.
+
+    For each operation and environment the first job opens a session (a tool instance holding the HTTP pool and
+    the token); every later job runs on a fresh tool instance sharing that session's pool and token.
+    """
+
+    def __init__(self, username=None, password=None, client_id=None, client_secret=None, jobs=4, pool_size=32,
+                 timeout=60, retries=3, token_cache=None):
+        self.username = username
+        self.password = password
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.token_cache = token_cache
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.ids = itertools.count(1)
+        self.jobs = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.session_lock = threading.Lock()
+
+    def submit(self, request, on_done=None):
+        """
+        Queue a job ({operation, input, output, environment, options}) and return its state; on_done is called
+        with the final state
+        """
+        job = self.parse_job(request)
+        with self.lock:
+            job['id'] = f"{int(time.time())}-{next(self.ids)}"
+            self.jobs[job['id']] = job
+            self.prune()
+            job['future'] = self.executor.submit(self.run_job, job)
+        if on_done:
+            job['future'].add_done_callback(lambda future: on_done(future.result()))
+        return self.state(job)
+
+    def parse_job(self, request):
+        operation = request.get('operation')
+        if operation not in JOB_OPTIONS:
+            raise ValueError(f"operation must be one of {', '.join(JOB_OPTIONS)}")
+        if operation == 'addidentifier' and not (self.client_id and self.client_secret):
+            raise ValueError("the server was started without --client-id / --client-secret")
+        if operation != 'addidentifier' and not (self.username and self.password):
+            raise ValueError("the server was started without -u / -p")
+        if not request.get('input') or not os.path.isfile(request['input']):
+            raise ValueError(f"input file not found: {request.get('input')}")
+        if not request.get('output'):
+            raise ValueError("output is required")
+        environment = request.get('environment', 'test')
+        if environment not in ENVIRONMENTS:
+            raise ValueError(f"environment must be one of {', '.join(ENVIRONMENTS)}")
+
+        options = request.get('options') or {}
+        allowed = JOB_OPTIONS[operation]
+        unknown = set(options) - set(allowed)
+        if unknown:
+            raise ValueError(f"unknown options for {operation}: {', '.join(sorted(unknown))}")
+        options = {name: job_option(name, allowed[name], value) for name, value in options.items()}
+        return {
+            'operation': operation,
+            'input': os.path.abspath(request['input']),
+            'output': os.path.abspath(request['output']),
+            'environment': environment,
+            'options': options,
+            'status': 'queued',
+            'submitted_at': time.time(),
+        }
+
+    def run_job(self, job):
+        job['status'] = 'running'
+        job['started_at'] = time.time()
+        try:
+            snapshot = self.execute(job)
+            job['rows'] = snapshot['rows']
+            job['requests'] = {endpoint: stats['status_counts'] for endpoint, stats in snapshot['requests'].items()}
+            job['status'] = 'succeeded'
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+        job['finished_at'] = time.time()
+        print(f"Job {job['id']} ({job['operation']} {job['input']}) {job['status']} in "
+              f"{job['finished_at'] - job['started_at']:.1f}s")
+        return self.state(job)
+
+    def execute(self, job):
+        """
+        Run the job on a tool instance sharing the session's pool and token; returns the snapshot of its own metrics
+        """
+        session = self.session(job['operation'], job['environment'])
+        if job['operation'] == 'addidentifier':
+            app = SystemCliAddIdentifier(input_filename=job['input'], output_filename=job['output'],
+                                         environment=job['environment'], http=session.http,
+                                         authenticator=session.authenticator, **job['options'])
+        else:
+            app = SystemcliCreate(username=self.username, password=self.password, input_filename=job['input'],
+                                  output_filename=job['output'], environment=job['environment'],
+                                  lookup_only=job['operation'] == 'lookup', http=session.http,
+                                  token_manager=session.token_manager, **job['options'])
+        with app:
+            app.execute()
+        return app.metrics.snapshot()
+
+    def session(self, operation, environment):
+        kind = 'addidentifier' if operation == 'addidentifier' else 'create'
+        with self.session_lock:
+            session = self.sessions.get((kind, environment))
+            if session is None:
+                if kind == 'addidentifier':
+                    session = SystemCliAddIdentifier(self.client_id, self.client_secret, environment=environment,
+                                                     max_in_flight=self.pool_size, timeout=self.timeout,
+                                                     retries=self.retries, token_cache=self.token_cache)
+                else:
+                    session = SystemcliCreate(username=self.username, password=self.password,
+                                              environment=environment, pool_size=self.pool_size,
+                                              timeout=self.timeout, retries=self.retries,
+                                              token_cache=self.token_cache)
+                # Opens the pool and logs in once; closed in close()
+                session.__enter__()
+                self.sessions[(kind, environment)] = session
+        return session
+
+    def state(self, job):
+        return {key: value for key, value in job.items() if key != 'future'}
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"unknown job: {job_id}")
+        return self.state(job)
+
+    def wait(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            raise ValueError(f"unknown job: {job_id}")
+        return job['future'].result()
+
+    def list_jobs(self):
+        with self.lock:
+            return [self.state(job) for job in self.jobs.values()]
+
+    def prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] in ('succeeded', 'failed')]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
+
+    def handle(self, request):
+        """
+        Answer one request of the socket protocol
+        """
+        command = request.get('command', 'submit')
+        if command == 'submit':
+            state = self.submit(request)
+            return self.wait(state['id']) if request.get('wait') else state
+        if command == 'status':
+            return self.status(request.get('job'))
+        if command == 'wait':
+            return self.wait(request.get('job'))
+        if command == 'jobs':
+            return {'jobs': self.list_jobs()}
+        raise ValueError(f"unknown command: {command}")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for session in self.sessions.values():
+            session.__exit__(None, None, None)
+        self.sessions = {}
+
+
+class SocketHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON request per line, answered with one JSON line
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.job_server.handle(json.loads(line))
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response, default=str).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class SocketServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, job_server):
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            # Left by a previous server; anything else at the path is not ours to delete
+            if not stat.S_ISSOCK(mode):
+                raise ValueError(f"{path} exists and is not a socket")
+            os.remove(path)
+        # The socket is created readable only by the owner, so it is never open to others, even briefly
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, SocketHandler)
+        finally:
+            os.umask(umask)
+        self.job_server = job_server
+
+
+class SpoolWatcher:
+    """
+    Spool directory mode: a job file <name>.json dropped in incoming/ is moved to running/ while it runs, and its
+    final state is written to done/<name>.json. Writers should create the file elsewhere and rename it into
+    incoming/ so a half-written job is never picked up.
+    """
+
+    def __init__(self, directory, job_server):
+        self.job_server = job_server
+        self.incoming, self.running, self.done = (os.path.join(directory, name)
+                                                  for name in ('incoming', 'running', 'done'))
+        for path in (self.incoming, self.running, self.done):
+            os.makedirs(path, exist_ok=True)
+        self.stopping = threading.Event()
+
+    def run(self):
+        for name in sorted(os.listdir(self.running)):
+            if name.endswith('.json'):
+                self.requeue(name)
+        while not self.stopping.is_set():
+            for name in sorted(os.listdir(self.incoming)):
+                if name.endswith('.json'):
+                    self.pick_up(name)
+            self.stopping.wait(SPOOL_POLL_INTERVAL)
+
+    def requeue(self, name):
+        """
+        Queue again a job left in running/ by a previous server. Its POSTs are not idempotent, so a job that can
+        resume does, from the journal next to its output, instead of creating its rows a second time.
+        """
+        running_path = os.path.join(self.running, name)
+        try:
+            with open(running_path, 'r', encoding='utf-8') as f:
+                job = json.load(f)
+        except ValueError:
+            # Not a job at all: pick_up reports it as failed
+            os.replace(running_path, os.path.join(self.incoming, name))
+            return
+        if isinstance(job, dict) and isinstance(job.get('options') or {}, dict) and \
+                'resume' in JOB_OPTIONS.get(job.get('operation'), {}):
+            job['options'] = dict(job.get('options') or {}, resume=True)
+        tmp_path = os.path.join(self.incoming, f".{name}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.incoming, name))
+        os.remove(running_path)
+
+    def pick_up(self, name):
+        running_path = os.path.join(self.running, name)
+        try:
+            os.replace(os.path.join(self.incoming, name), running_path)
+        except FileNotFoundError:
+            return
+        try:
+            with open(running_path, 'r', encoding='utf-8') as f:
+                self.job_server.submit(json.load(f), on_done=lambda state: self.finish(name, state))
+        except Exception as e:
+            self.finish(name, {'status': 'failed', 'error': str(e)})
+
+    def finish(self, name, state):
+        tmp_path = os.path.join(self.done, f".{name}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2, default=str)
+        os.replace(tmp_path, os.path.join(self.done, name))
+        running_path = os.path.join(self.running, name)
+        if os.path.exists(running_path):
+            os.remove(running_path)
+
+    def stop(self):
+        self.stopping.set()
+
+
+def main():
+    epilog = (
+        "NAME\n"
+        "       systemcli-server - Resident job server for the SYSTEM command line tools\n\n"
+        "SYNOPSIS\n"
+        "       systemcli-server (--socket path | --spool directory) [options]\n\n"
+        "DESCRIPTION\n"
+        "       systemcli-server stays running and processes create, lookup and addidentifier jobs submitted\n"
+        "       over a local Unix socket or through a spool directory. Jobs run concurrently and share one\n"
+        "       warm HTTP connection pool and one access token per operation and environment, so a job costs\n"
+        "       no interpreter start, import or login.\n\n"
+        "       A job is a JSON object:\n"
+        "           {\"operation\": \"create\" | \"lookup\" | \"addidentifier\", \"input\": path, \"output\": path,\n"
+        "            \"environment\": \"test\", \"options\": {...}}\n"
+        "       options may hold workers, resume, retry_attempts, lookup_before_create, ledger_path and\n"
+        "       compress_requests for create (workers and retry_attempts for lookup), and max_in_flight,\n"
+        "       resume, retry_attempts, ledger_path and compress_requests for addidentifier. The job state\n"
+        "       reports status (queued, running, succeeded, failed), error, the rows per result status and the\n"
+        "       job's requests per endpoint and status code.\n\n"
+        "OPTIONS\n"
+        "       -h, --help\n"
+        "           Show this help message and exit.\n\n"
+        "       --socket path\n"
+        "           Listen on this Unix socket (readable only by you). Send one JSON request per line; each one\n"
+        "           is answered with one JSON line. A job object submits the job and returns its state at once,\n"
+        "           or when it ends with \"wait\": true. {\"command\": \"status\", \"job\": id},\n"
+        "           {\"command\": \"wait\", \"job\": id} and {\"command\": \"jobs\"} query submitted jobs.\n\n"
+        "       --spool directory\n"
+        "           Watch directory/incoming for job files (name.json; write them elsewhere and rename them in).\n"
+        "           A job runs from directory/running and its final state is written to directory/done/name.json.\n"
+        "           Jobs a stopped server left in directory/running are run again on start, create and\n"
+        "           addidentifier jobs with resume set so that no row is sent twice.\n\n"
+        "       -u username, -p password\n"
+        "           Credentials for create and lookup jobs.\n\n"
+        "       --client-id client_id, --client-secret client_secret\n"
+        "           Credentials for addidentifier jobs.\n\n"
+        "       --jobs N\n"
+        "           Number of jobs run at the same time (default 4); the others wait in a queue.\n\n"
+        "       --pool-size N\n"
+        "           Connections kept open per operation and environment (default 32).\n\n"
+        "       --token-cache path\n"
+        "           Keep the access tokens in this file (readable only by you) across server restarts.\n\n"
+        "       --timeout seconds\n"
+        "           Timeout for each HTTP request (default 60).\n\n"
+        "       --retries N\n"
+        "           Number of retries on connection errors (default 3).\n\n"
+        "USAGE EXAMPLE\n"
+        "       ./systemcliserver.py --socket /tmp/systemcli.sock -u USER -p PASS\n"
+        "       echo '{\"operation\": \"create\", \"input\": \"in.csv\", \"output\": \"out.csv\",\n"
+        "             \"wait\": true}' | socat - UNIX-CONNECT:/tmp/systemcli.sock\n"
+    )
+
+    parser = argparse.ArgumentParser(
+        epilog=epilog,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        add_help=False
+    )
+    parser.add_argument("-h", "--help", action="help", default=argparse.SUPPRESS, help=argparse.SUPPRESS)
+    parser.add_argument("--socket", dest="socket_path", help=argparse.SUPPRESS)
+    parser.add_argument("--spool", dest="spool_directory", help=argparse.SUPPRESS)
+    parser.add_argument("-u", dest="username", help=argparse.SUPPRESS)
+    parser.add_argument("-p", dest="password", help=argparse.SUPPRESS)
+    parser.add_argument("--client-id", dest="client_id", help=argparse.SUPPRESS)
+    parser.add_argument("--client-secret", dest="client_secret", help=argparse.SUPPRESS)
+    parser.add_argument("--jobs", dest="jobs", type=int, default=4, help=argparse.SUPPRESS)
+    parser.add_argument("--pool-size", dest="pool_size", type=int, default=32, help=argparse.SUPPRESS)
+    parser.add_argument("--token-cache", dest="token_cache", help=argparse.SUPPRESS)
+    parser.add_argument("--timeout", dest="timeout", type=float, default=60, help=argparse.SUPPRESS)
+    parser.add_argument("--retries", dest="retries", type=int, default=3, help=argparse.SUPPRESS)
+
+    if len(sys.argv) == 1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    args = parser.parse_args()
+    if not args.socket_path and not args.spool_directory:
+        parser.error("--socket or --spool must be specified")
+    if not (args.username and args.password) and not (args.client_id and args.client_secret):
+        parser.error("-u and -p, or --client-id and --client-secret, must be specified")
+
+    # Imported once here so that no job pays for it
+    try:
+        import pandas  # noqa: F401
+        import requests  # noqa: F401
+    except ImportError:
+        pass
+
+    job_server = JobServer(username=args.username, password=args.password, client_id=args.client_id,
+                           client_secret=args.client_secret, jobs=args.jobs, pool_size=args.pool_size,
+                           timeout=args.timeout, retries=args.retries, token_cache=args.token_cache)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    socket_server = None
+    spool_watcher = None
+    if args.socket_path:
+        socket_server = SocketServer(args.socket_path, job_server)
+        threading.Thread(target=socket_server.serve_forever, daemon=True).start()
+        print(f"Listening on {args.socket_path}")
+    if args.spool_directory:
+        spool_watcher = SpoolWatcher(args.spool_directory, job_server)
+        threading.Thread(target=spool_watcher.run, daemon=True).start()
+        print(f"Watching {spool_watcher.incoming}")
+
+    try:
+        while not stopping.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    print("Stopping: waiting for the running jobs...")
+    if socket_server:
+        socket_server.shutdown()
+        socket_server.server_close()
+        os.remove(args.socket_path)
+    if spool_watcher:
+        spool_watcher.stop()
+    job_server.close()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
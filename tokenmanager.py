@@ -0,0 +1,146 @@
+import base64
+import json
+import os
+import threading
+import time
+
+# Seconds before an early renewal that failed is tried again, while the current token is still valid
+EARLY_RENEW_RETRY_DELAY = 5
+
+
+def jwt_expiry(token):
+    """
+    Best-effort read of the 'exp' claim of a JWT (optionally prefixed with 'Bearer '), or None
+    """
+    if not token:
+        return None
+    try:
+        payload = token.split(' ')[-1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp else None
+    except (IndexError, ValueError, AttributeError, TypeError):
+        return None
+
+
+class TokenManager:
+    """
+    Keeps an access token valid for many concurrent callers.
+
+    fetch() must return (token, expires_at) where expires_at is an epoch timestamp or None when unknown.
+    The token is renewed refresh_margin seconds before it expires; only one caller renews at a time while the
+    others keep using the current token (or wait for the new one if it already expired). An early renewal that
+    fails is reported and retried later: callers keep the current token until it actually expires. With
+    cache_path set, tokens with a known expiry are shared between invocations through a small JSON file readable
+    only by the current user.
+    """
+
+    def __init__(self, fetch, cache_path=None, cache_key=None, refresh_margin=60):
+        self.fetch = fetch
+        self.cache_path = os.path.expanduser(cache_path) if cache_path else None
+        self.cache_key = cache_key
+        self.refresh_margin = refresh_margin
+        self.margin = refresh_margin
+        self.renew_after = 0
+        self.token = None
+        self.expires_at = None
+        self.lock = threading.Lock()
+
+    def is_valid(self, margin=0):
+        if not self.token:
+            return False
+        return self.expires_at is None or time.time() < self.expires_at - margin
+
+    def get(self):
+        if self.is_valid(self.margin):
+            return self.token
+
+        if self.is_valid():
+            # Still usable: only one caller renews early, the others keep the current token meanwhile
+            if not self.lock.acquire(blocking=False):
+                return self.token
+        else:
+            self.lock.acquire()
+        try:
+            if not self.is_valid(self.margin):
+                if not self.token and self.load_cache() and self.is_valid(self.margin):
+                    return self.token
+                if self.is_valid():
+                    self.renew_early()
+                else:
+                    self.renew()
+            return self.token
+        finally:
+            self.lock.release()
+
+    def renew_early(self):
+        if time.time() < self.renew_after:
+            return
+        try:
+            self.renew()
+        except Exception as e:
+            self.renew_after = time.time() + EARLY_RENEW_RETRY_DELAY
+            print(f"\nCould not renew the access token ({e}); using the current one until it expires.")
+
+    def invalidate(self, stale_token):
+        """
+        Called after a 401: renew unless another caller already replaced the stale token
+        """
+        with self.lock:
+            if self.token == stale_token or not self.token:
+                self.renew()
+            return self.token
+
+    def refresh(self):
+        with self.lock:
+            self.renew()
+            return self.token
+
+    def renew(self):
+        token, expires_at = self.fetch()
+        self.set_token(token, expires_at)
+        if token and expires_at:
+            self.save_cache()
+
+    def set_token(self, token, expires_at):
+        self.token = token
+        self.expires_at = expires_at
+        # Short-lived tokens are renewed at half their lifetime rather than on every call
+        lifetime = expires_at - time.time() if expires_at else None
+        self.margin = min(self.refresh_margin, lifetime / 2) if lifetime and lifetime > 0 else self.refresh_margin
+
+    def load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return False
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                entry = json.load(f).get(self.cache_key)
+        except (OSError, ValueError):
+            return False
+        if not entry:
+            return False
+        self.set_token(entry.get('token'), entry.get('expires_at'))
+        if self.is_valid(self.margin):
+            print('Using cached token.')
+        return True
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        entries = {}
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+        entries = {key: entry for key, entry in entries.items() if (entry.get('expires_at') or 0) > time.time()}
+        entries[self.cache_key] = {'token': self.token, 'expires_at': self.expires_at}
+
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.cache_path)